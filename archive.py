@@ -0,0 +1,181 @@
+import cPickle as pickle
+import os
+import zipfile
+from collections import OrderedDict
+
+import numpy
+
+import timeline
+from trajectory import Trajectory
+
+ARCHIVE_VERSION = 1
+# Event tracks whose events are lists of actor ids.
+ACTOR_TRACKS = ("removed_ships", "added_drones", "removed_drones")
+
+
+class StringTable(object):
+    """
+    Numbers the strings stored in an archive. str and unicode are told apart,
+    since they end up differently in the scene files.
+    """
+    def __init__(self):
+        self.strings = []
+        self.numbers = {}
+
+    def add(self, string):
+        key = (type(string), string)
+        number = self.numbers.get(key)
+        if number is None:
+            number = self.numbers[key] = len(self.strings)
+            self.strings.append(string)
+        return number
+
+
+def pack_trajectories(trajectories, strings):
+    """
+    Concatenates the trajectories of a dict of actors into single arrays, in
+    the order the dict iterates in.
+    """
+    actor_ids = list(trajectories)
+    rows = [trajectories[actor_id] for actor_id in actor_ids]
+    return {
+        "actors": numpy.array([strings.add(actor_id) for actor_id in actor_ids], dtype=numpy.int32),
+        "offsets": numpy.cumsum([0] + [len(row) for row in rows]).astype(numpy.int64),
+        "frames": numpy.concatenate([row.frames for row in rows] or [numpy.empty(0, numpy.int64)]),
+        "ticks": numpy.concatenate([row.ticks for row in rows] or [numpy.empty(0, numpy.int64)]),
+        "positions": numpy.concatenate([row.positions for row in rows] or [numpy.empty((0, 3))]),
+        "velocities": numpy.concatenate([row.velocities for row in rows] or [numpy.empty((0, 3))]),
+    }
+
+
+def unpack_trajectories(arrays, prefix, strings):
+    # A dict rebuilt from the same keys need not iterate in the same order,
+    # and the scene files add the actors in that order. Every lookup in an
+    # npz file reads the array from the zip again.
+    offsets, frames, ticks, positions, velocities = [
+        arrays[prefix + key] for key in ("offsets", "frames", "ticks", "positions", "velocities")
+    ]
+    trajectories = OrderedDict()
+    for i, actor in enumerate(arrays[prefix + "actors"].tolist()):
+        rows = slice(offsets[i], offsets[i + 1])
+        trajectories[strings[actor]] = Trajectory.from_arrays(
+            frames[rows].copy(), ticks[rows].copy(), positions[rows].copy(), velocities[rows].copy()
+        )
+    return trajectories
+
+
+def pack_lists(lists, strings):
+    """
+    Flattens lists of strings into their numbers and the offsets where each
+    list starts.
+    """
+    offsets = numpy.cumsum([0] + [len(items) for items in lists]).astype(numpy.int64)
+    items = numpy.array([strings.add(item) for items in lists for item in items], dtype=numpy.int32)
+    return offsets, items
+
+
+def unpack_lists(offsets, items, strings):
+    items = [strings[item] for item in items.tolist()]
+    offsets = offsets.tolist()
+    return [items[start:end] for start, end in zip(offsets, offsets[1:])]
+
+
+def pack_events(scene_dict, strings):
+    arrays = {}
+    for key in ACTOR_TRACKS:
+        track = scene_dict[key]
+        arrays[key + "_ticks"] = numpy.array(track.ticks, dtype=numpy.int64)
+        arrays[key + "_offsets"], arrays[key + "_actors"] = pack_lists(track.events, strings)
+
+    projectiles = scene_dict["projectiles"]
+    arrays["projectile_ticks"] = numpy.array(projectiles.ticks, dtype=numpy.int64)
+    arrays["projectile_sources"], arrays["projectile_targets"], arrays["projectile_ammo"] = [
+        numpy.array([strings.add(firing[key]) for firing in projectiles.events], dtype=numpy.int32)
+        for key in ("source_id", "target_id", "ammo_graphic_resource")
+    ]
+    arrays["projectile_slot_offsets"] = numpy.cumsum([0] + [len(firing["slots"]) for firing in projectiles.events]).astype(numpy.int64)
+    arrays["projectile_slots"] = numpy.array([slot for firing in projectiles.events for slot in firing["slots"]], dtype=numpy.int32)
+    return arrays
+
+
+def unpack_events(arrays, scene_dict, strings):
+    for key in ACTOR_TRACKS:
+        track = timeline.EventTrack()
+        track.ticks = arrays[key + "_ticks"].tolist()
+        track.events = unpack_lists(arrays[key + "_offsets"], arrays[key + "_actors"], strings)
+        scene_dict[key] = track
+
+    projectiles = timeline.EventTrack()
+    projectiles.ticks = arrays["projectile_ticks"].tolist()
+    slot_offsets = arrays["projectile_slot_offsets"].tolist()
+    slots = arrays["projectile_slots"].tolist()
+    for i, (source, target, ammo) in enumerate(zip(arrays["projectile_sources"].tolist(), arrays["projectile_targets"].tolist(),
+                                                   arrays["projectile_ammo"].tolist())):
+        projectiles.events.append({
+            "source_id": strings[source],
+            "target_id": strings[target],
+            "slots": slots[slot_offsets[i]:slot_offsets[i + 1]],
+            "ammo_graphic_resource": strings[ammo],
+        })
+    scene_dict["projectiles"] = projectiles
+
+
+def save(file_path, scene_dict, target_url):
+    """
+    Writes a parsed replay to a compressed .npz archive. The trajectories and
+    events go into arrays, and the rest of the scene dict, the ship and drone
+    metadata and the strings the arrays refer to, into a small pickled header.
+    """
+    strings = StringTable()
+    arrays = {}
+    for key, value in pack_trajectories(scene_dict["ships"], strings).iteritems():
+        arrays["ship_" + key] = value
+    for key, value in pack_trajectories(scene_dict["drones"]["locations"], strings).iteritems():
+        arrays["drone_" + key] = value
+    arrays.update(pack_events(scene_dict, strings))
+
+    header = {
+        "target_url": target_url,
+        "strings": strings.strings,
+        # The scene name, nebula and timing, and the metadata of every ship.
+        "scene": dict(
+            (key, value) for key, value in scene_dict.iteritems()
+            if key not in ("ships", "drones", "projectiles") + ACTOR_TRACKS
+        ),
+        "drones": dict((key, value) for key, value in scene_dict["drones"].iteritems() if key != "locations"),
+    }
+    arrays["header"] = numpy.frombuffer(pickle.dumps((ARCHIVE_VERSION, header), pickle.HIGHEST_PROTOCOL), dtype=numpy.uint8)
+
+    temp_path = file_path + ".tmp.npz"
+    numpy.savez_compressed(temp_path, **arrays)
+    if os.path.exists(file_path):
+        # Windows will not rename over an existing file.
+        os.remove(file_path)
+    os.rename(temp_path, file_path)
+
+
+def load(file_path):
+    """
+    Returns the target url and the scene dict stored in an archive, or None
+    if there is no usable archive at file_path.
+    """
+    if not os.path.exists(file_path):
+        return None
+    try:
+        arrays = numpy.load(file_path)
+        version, header = pickle.loads(arrays["header"].tostring())
+    except (IOError, KeyError, zipfile.BadZipfile, pickle.UnpicklingError, EOFError, ValueError):
+        print "Ignoring unreadable archive", file_path
+        return None
+    if version != ARCHIVE_VERSION:
+        print "Ignoring archive from a different version", file_path
+        return None
+
+    strings = header["strings"]
+    scene_dict = dict(header["scene"])
+    scene_dict["ships"] = unpack_trajectories(arrays, "ship_", strings)
+    scene_dict["drones"] = dict(header["drones"])
+    scene_dict["drones"]["locations"] = unpack_trajectories(arrays, "drone_", strings)
+    unpack_events(arrays, scene_dict, strings)
+    arrays.close()
+    return header["target_url"], scene_dict
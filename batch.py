@@ -0,0 +1,132 @@
+import argparse
+import multiprocessing
+import re
+import sys
+import time
+import traceback
+
+import crestscrape
+import main
+
+DESCRIPTION = "Converts every match of a tournament or series, or a list of \
+matches, into EveProbe scene files using a pool of processes. Arguments can \
+be read from a file, one per line, by passing @file."
+
+DEFAULT_PROCESSES = multiprocessing.cpu_count()
+
+
+class MatchResult(object):
+    def __init__(self, target_url, scene_name=None, error=None, duration=0.0):
+        self.target_url = target_url
+        self.scene_name = scene_name
+        self.error = error
+        self.duration = duration
+
+    def succeeded(self):
+        return self.error is None
+
+
+def get_scene_name_suffix(target_url):
+    """
+    The same two teams can meet in several matches of a series, so the ids in
+    the match url are added to the scene name, e.g. " 4-120-0" for
+    /tournaments/4/series/120/matches/0/.
+    """
+    path = crestscrape.urlparse.urlparse(target_url).path
+    return " " + "-".join(re.findall(r"\d+", path))
+
+
+def initialize_worker(args):
+    # Every worker opens its own connection to the response cache and its own
+    # CREST session, and keeps its static resources in memory for all the
+    # matches it converts.
+    main.open_response_cache(args)
+    main.create_crest_client(args)
+
+
+def convert_match(job):
+    target_url, save_folder, ships_to_follow, curve_options, checkpoint_folder, checkpoint_interval, command_quantum, drone_budget = job
+    start = time.time()
+    try:
+        scene_name = main.main(target_url, save_folder, ships_to_follow, curve_options=curve_options,
+                               scene_name_suffix=get_scene_name_suffix(target_url),
+                               checkpoint_folder=checkpoint_folder, checkpoint_interval=checkpoint_interval,
+                               command_quantum=command_quantum, drone_budget=drone_budget)
+    except Exception:
+        return MatchResult(target_url, error=traceback.format_exc(), duration=time.time() - start)
+    return MatchResult(target_url, scene_name=scene_name, duration=time.time() - start)
+
+
+def convert_matches(match_urls, save_folder, args, processes=DEFAULT_PROCESSES, ships_to_follow=None, curve_options=None):
+    """
+    Converts the matches on a pool of processes and returns a MatchResult for
+    each of them, in the same order.
+    """
+    jobs = [
+        (target_url, save_folder, ships_to_follow, curve_options, args.checkpoint_folder, args.checkpoint_interval,
+         main.get_command_quantum(args), main.get_drone_budget(args))
+        for target_url in match_urls
+    ]
+    pool = multiprocessing.Pool(processes, initialize_worker, (args,))
+    try:
+        results = pool.map(convert_match, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def print_summary(results):
+    print
+    print "Converted {succeeded} of {total} matches".format(
+        succeeded=len([r for r in results if r.succeeded()]),
+        total=len(results),
+    )
+    for result in results:
+        if result.succeeded():
+            print "  OK     {duration:7.1f}s  {url}  {scene_name}".format(
+                duration=result.duration, url=result.target_url, scene_name=result.scene_name)
+        else:
+            print "  FAILED {duration:7.1f}s  {url}".format(duration=result.duration, url=result.target_url)
+            for line in result.error.rstrip().splitlines():
+                print "         " + line
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description=DESCRIPTION, fromfile_prefix_chars="@")
+    parser.add_argument("target_urls", help="Urls of tournaments, series or matches", nargs="+")
+    parser.add_argument("-o", "--save-folder", help="A directory in which to save the generated scene data", default=".")
+    main.add_follow_arguments(parser)
+    parser.add_argument("-j", "--processes", help="Number of matches converted at the same time", default=DEFAULT_PROCESSES, type=int)
+    main.add_curve_arguments(parser)
+    main.add_scene_arguments(parser)
+    main.add_drone_budget_arguments(parser)
+    main.add_client_arguments(parser)
+    main.add_checkpoint_arguments(parser)
+    main.add_cache_arguments(parser)
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    args = parser.parse_args()
+    main.check_cache_arguments(parser, args)
+
+    main.open_response_cache(args)
+    main.create_crest_client(args)
+    # Importing is done once up front, not by every worker, and the workers
+    # split the rate limit between them.
+    args.import_cache = None
+    if args.rate_limit:
+        args.rate_limit /= float(args.processes)
+    match_urls = []
+    for target_url in args.target_urls:
+        for match_url in crestscrape.get_match_urls(target_url):
+            if match_url not in match_urls:
+                match_urls.append(match_url)
+    print "Converting", len(match_urls), "matches"
+
+    results = convert_matches(match_urls, args.save_folder, args, args.processes, args.follow, main.get_curve_options(args))
+    print_summary(results)
+    if not all(result.succeeded() for result in results):
+        sys.exit(1)
@@ -0,0 +1,226 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from cStringIO import StringIO
+
+import cache
+import crestclient
+import crestscrape
+import jsonbackend
+import main
+import metrics
+import probe
+import red
+import synthetic
+
+DESCRIPTION = "Times the conversion of a synthetic match, served from a \
+pre-seeded cache or a local stand-in for CREST, and appends the results to a \
+json lines file so that they can be compared across versions."
+
+DEFAULT_RESULTS_PATH = "benchmark_results.jsonl"
+DEFAULT_REPEAT = 3
+STAGES = ("fetch", "parse", "red", "yaml", "save")
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.stages = OrderedDict((stage, 0.0) for stage in STAGES)
+
+    def add(self, stage, duration):
+        self.stages[stage] += duration
+
+
+class TimedFetches(object):
+    """
+    Adds the time spent in crestscrape.fetch_data_from_endpoint, cache reads
+    included, to the fetch stage while in use. Fetches run at the same time
+    on a thread pool while setting up the scene, so the stage gets the wall
+    clock time during which any fetch was running, not the sum of their
+    durations, which would leave the parse stage short.
+    """
+    def __init__(self, timer):
+        self.timer = timer
+        self.fetch = None
+        self.lock = threading.Lock()
+        self.running = 0
+        self.first_start = None
+
+    def started(self):
+        with self.lock:
+            if self.running == 0:
+                self.first_start = time.time()
+            self.running += 1
+
+    def finished(self):
+        with self.lock:
+            self.running -= 1
+            if self.running == 0:
+                self.timer.add("fetch", time.time() - self.first_start)
+
+    def __enter__(self):
+        self.fetch = fetch = crestscrape.fetch_data_from_endpoint
+
+        def timed_fetch(*args, **kwargs):
+            self.started()
+            try:
+                return fetch(*args, **kwargs)
+            finally:
+                self.finished()
+
+        crestscrape.fetch_data_from_endpoint = timed_fetch
+        return self
+
+    def __exit__(self, *exc_info):
+        crestscrape.fetch_data_from_endpoint = self.fetch
+
+
+def convert(target_url, save_folder):
+    """
+    Does what main.main does, timing each stage. The parse stage is the time
+    it took to build the scene dict, less the time spent fetching.
+    Returns the timer and the paths of the saved files.
+    """
+    timer = StageTimer()
+    start = time.time()
+    with TimedFetches(timer):
+        scene_dict = crestscrape.get_scene_dict(target_url)
+    timer.add("parse", time.time() - start - timer.stages["fetch"])
+
+    scene_save_path, red_save_path = main.get_save_paths(save_folder, scene_dict["scene_name"])
+    scene_file = probe.SceneFile(None)
+    red_file = red.RedFile(red_save_path)
+    start = time.time()
+    main.create_scene_file_header(scene_dict, scene_file, None)
+    main.add_initial_scene_data(scene_dict, scene_file, red_file)
+    timer.add("red", time.time() - start)
+
+    # The yaml is generated in memory, so that the save stage is only the
+    # writing of the files.
+    start = time.time()
+    main.wait_for_loads(scene_file)
+    main.add_timed_events(scene_dict, scene_file)
+    metrics.count("commands", len(scene_file.data["commands"]))
+    scene_yaml = StringIO()
+    scene_file.write(scene_yaml)
+    timer.add("yaml", time.time() - start)
+
+    start = time.time()
+    red_file.close()
+    with open(scene_save_path, "w") as f:
+        f.write(scene_yaml.getvalue())
+    timer.add("save", time.time() - start)
+    return timer, scene_save_path, red_save_path
+
+
+def run_benchmark(args, repeat):
+    """
+    Converts the synthetic match described by args repeat times, each time
+    with an empty static resource cache and a fresh response cache, and
+    returns a result record for each run.
+    """
+    server = None
+    if args.server:
+        server = synthetic.StandInServer()
+        base_url = server.base_url
+    else:
+        base_url = synthetic.DEFAULT_BASE_URL
+    print "Generating a match with {ships} ships, {drones} drones and {frames} frames".format(
+        ships=args.ships, drones=args.drones, frames=args.frames)
+    match = synthetic.SyntheticMatch(base_url, args.ships, args.drones, args.frames, args.fire_rate, args.seed)
+    if server is not None:
+        server.serve(match)
+        server.start()
+
+    results = []
+    work_folder = tempfile.mkdtemp(prefix="benchmark")
+    stdout = sys.stdout
+    try:
+        for run in range(repeat):
+            run_folder = os.path.join(work_folder, str(run))
+            response_cache = cache.PackCache(run_folder + ".pack")
+            if server is None:
+                match.seed_cache(response_cache)
+            crestscrape.set_response_cache(response_cache)
+            crestscrape.set_crest_client(crestclient.CrestClient())
+            crestscrape.static_resources.clear()
+            metrics.metrics.reset()
+
+            # The conversion prints every url it fetches.
+            sys.stdout = open(os.devnull, "w")
+            try:
+                timer, scene_save_path, red_save_path = convert(match.match_url, run_folder)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            response_cache.close()
+
+            total = sum(timer.stages.values())
+            report = metrics.metrics.report()
+            results.append(OrderedDict((
+                ("label", args.label),
+                ("date", time.strftime("%Y-%m-%dT%H:%M:%S")),
+                ("python", platform.python_version()),
+                ("json_backend", jsonbackend.BACKEND),
+                ("source", "server" if server is not None else "cache"),
+                ("ships", args.ships),
+                ("drones", args.drones),
+                ("frames", args.frames),
+                ("fire_rate", args.fire_rate),
+                ("seed", args.seed),
+                ("run", run),
+                ("stages", timer.stages),
+                ("total", total),
+                ("frames_per_second", args.frames / max(total, 1e-6)),
+                ("red_bytes", os.path.getsize(red_save_path)),
+                ("yaml_bytes", os.path.getsize(scene_save_path)),
+                ("counters", report["counters"]),
+                ("peak_memory_bytes", report["peak_memory_bytes"]),
+            )))
+            print "Run {run}: {total:.2f}s".format(run=run, total=total)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+        if server is not None:
+            server.stop()
+    return results
+
+
+def print_summary(results):
+    print "Stage   best (s)  median (s)"
+    for stage in STAGES + ("total",):
+        if stage == "total":
+            durations = sorted(result["total"] for result in results)
+        else:
+            durations = sorted(result["stages"][stage] for result in results)
+        print "{stage:<7} {best:>8.3f}  {median:>10.3f}".format(
+            stage=stage, best=durations[0], median=durations[len(durations) // 2])
+
+
+def save_results(results, file_path):
+    with open(file_path, "a") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("--ships", help="Number of ships in the match", default=synthetic.DEFAULT_SHIPS, type=int)
+    parser.add_argument("--drones", help="Number of drones launched during the match", default=synthetic.DEFAULT_DRONES, type=int)
+    parser.add_argument("--frames", help="Number of replay frames", default=synthetic.DEFAULT_FRAMES, type=int)
+    parser.add_argument("--fire-rate", help="Chance of each ship starting to fire in a frame", default=synthetic.DEFAULT_FIRE_RATE, type=float)
+    parser.add_argument("--seed", help="Seed for generating the match", default=0, type=int)
+    parser.add_argument("--server", help="Fetch the match over HTTP from a local stand-in server instead of a pre-seeded cache", action="store_true")
+    parser.add_argument("-n", "--repeat", help="How many times to convert the match", default=DEFAULT_REPEAT, type=int)
+    parser.add_argument("-o", "--output", help="The json lines file the results are appended to", default=DEFAULT_RESULTS_PATH)
+    parser.add_argument("-l", "--label", help="A name for this version, stored with the results", default="")
+    args = parser.parse_args()
+    results = run_benchmark(args, args.repeat)
+    print_summary(results)
+    save_results(results, args.output)
+    print "Results appended to", args.output
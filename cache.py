@@ -0,0 +1,185 @@
+import os
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+
+DEFAULT_PACK_PATH = "cache.pack"
+MMAP_SIZE = 1 << 30
+STATIC_RESOURCE_CACHE_SIZE = 4096
+
+
+class DirectoryCache(object):
+    """
+    The original cache layout, one file per url in a directory.
+    """
+    def __init__(self, path="cache"):
+        self.path = path
+        if not os.path.exists(path):
+            try:
+                os.mkdir(path)
+            except OSError:
+                # Another crawler thread got there first.
+                pass
+
+    def get(self, key):
+        file_path = os.path.join(self.path, key)
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, 'r') as f:
+            return f.read()
+
+    def put(self, key, data):
+        file_path = os.path.join(self.path, key)
+        # Write to a temporary file first so that other threads never read a
+        # half written cache entry.
+        temp_path = "%s.%d.%d.tmp" % (file_path, os.getpid(), threading.current_thread().ident)
+        with open(temp_path, 'w') as f:
+            f.write(data)
+        try:
+            os.rename(temp_path, file_path)
+        except OSError:
+            # Windows will not rename over an existing file.
+            os.remove(file_path)
+            os.rename(temp_path, file_path)
+
+    def close(self):
+        pass
+
+
+class PackCache(object):
+    """
+    Stores all responses zlib compressed in a single sqlite file, keyed by the
+    same names the DirectoryCache uses for its files. Reads go through sqlite's
+    memory mapped I/O, so a warm run does not open a file per url.
+    """
+    def __init__(self, path=DEFAULT_PACK_PATH, compression_level=6):
+        self.path = path
+        self.compression_level = compression_level
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60.0, check_same_thread=False)
+        self.connection.text_factory = str
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA mmap_size=%d" % MMAP_SIZE)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, data BLOB NOT NULL)"
+        )
+        self.connection.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT data FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(row[0])
+
+    def put(self, key, data):
+        compressed = sqlite3.Binary(zlib.compress(data, self.compression_level))
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO responses (key, data) VALUES (?, ?)", (key, compressed))
+            self.connection.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def import_directory(self, directory):
+        """
+        Copies every entry of a DirectoryCache into the pack, skipping the ones
+        that are already there. Returns the number of entries imported.
+        """
+        imported = 0
+        with self.lock:
+            for file_name in os.listdir(directory):
+                if file_name.endswith(".tmp"):
+                    continue
+                with open(os.path.join(directory, file_name), 'r') as f:
+                    data = f.read()
+                compressed = sqlite3.Binary(zlib.compress(data, self.compression_level))
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO responses (key, data) VALUES (?, ?)", (file_name, compressed)
+                )
+                imported += cursor.rowcount
+            self.connection.commit()
+        return imported
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class StaticResourceCache(object):
+    """
+    Keeps decoded static resources (types, graphic ids, graphic resources) in
+    memory, evicting the least recently used ones once max_size is reached.
+    Concurrent requests for the same key wait for a single fetch, which is
+    called with the key and any extra arguments given to resolve.
+    The cached values are shared and must not be modified.
+    """
+    def __init__(self, fetch, max_size=STATIC_RESOURCE_CACHE_SIZE):
+        self.fetch = fetch
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def resolve(self, key, *fetch_args):
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.hits += 1
+                    value = self.entries.pop(key)
+                    self.entries[key] = value
+                    return value
+                pending = self.in_flight.get(key)
+                if pending is None:
+                    pending = threading.Event()
+                    self.in_flight[key] = pending
+                    self.misses += 1
+                    break
+            pending.wait()
+
+        try:
+            value = self.fetch(key, *fetch_args)
+            with self.lock:
+                self.entries[key] = value
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            pending.set()
+        return value
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        return "{hits} hits, {misses} misses, {evictions} evictions, {size} cached".format(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self.entries),
+        )
+
+
+def open_cache(path):
+    """
+    Opens an existing cache directory as a DirectoryCache, anything else as a
+    PackCache.
+    """
+    if os.path.isdir(path):
+        return DirectoryCache(path)
+    return PackCache(path)
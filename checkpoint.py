@@ -0,0 +1,97 @@
+import cPickle as pickle
+import os
+import struct
+import zlib
+
+CHECKPOINT_VERSION = 5
+DEFAULT_CHECKPOINT_FOLDER = "checkpoints"
+DEFAULT_CHECKPOINT_INTERVAL = 500
+# Each segment is stored zlib compressed after its length.
+SEGMENT_HEADER = struct.Struct("<I")
+
+
+def get_checkpoint_path(checkpoint_folder, match_key):
+    return os.path.join(checkpoint_folder, match_key + ".checkpoint")
+
+
+def pack_segment(segment):
+    data = zlib.compress(pickle.dumps(segment, pickle.HIGHEST_PROTOCOL))
+    return SEGMENT_HEADER.pack(len(data)) + data
+
+
+def save(file_path, segment):
+    """
+    Starts a new checkpoint holding just the first segment, replacing the
+    previous checkpoint only once the new one is complete.
+    """
+    folder = os.path.dirname(file_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    temp_path = file_path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(pack_segment((CHECKPOINT_VERSION, segment)))
+    if os.path.exists(file_path):
+        # Windows will not rename over an existing file.
+        os.remove(file_path)
+    os.rename(temp_path, file_path)
+
+
+def append(file_path, segment):
+    """
+    Adds a segment to the end of a checkpoint started with save. A segment
+    left incomplete by an interruption is dropped by load.
+    """
+    with open(file_path, "ab") as f:
+        f.write(pack_segment(segment))
+
+
+def read_segments(f):
+    """
+    Yields the segments in a checkpoint file and the offset after each, up to
+    the first incomplete or unreadable one.
+    """
+    while True:
+        header = f.read(SEGMENT_HEADER.size)
+        if len(header) < SEGMENT_HEADER.size:
+            return
+        size, = SEGMENT_HEADER.unpack(header)
+        data = f.read(size)
+        if len(data) < size:
+            return
+        try:
+            segment = pickle.loads(zlib.decompress(data))
+        except (zlib.error, pickle.UnpicklingError, EOFError, ValueError):
+            return
+        yield segment, f.tell()
+
+
+def load(file_path):
+    """
+    Returns the segments stored in a checkpoint, first to last, or None if
+    there is no usable checkpoint at file_path. Anything after the last
+    complete segment is cut off, so that the next segment follows it.
+    """
+    if not os.path.exists(file_path):
+        return None
+    segments = []
+    end = 0
+    with open(file_path, "rb") as f:
+        for segment, end in read_segments(f):
+            segments.append(segment)
+    if not segments:
+        print "Ignoring unreadable checkpoint", file_path
+        return None
+    version, segments[0] = segments[0]
+    if version != CHECKPOINT_VERSION:
+        print "Ignoring checkpoint from a different version", file_path
+        return None
+    if end < os.path.getsize(file_path):
+        print "Ignoring the incomplete end of checkpoint", file_path
+        with open(file_path, "r+b") as f:
+            f.truncate(end)
+    return segments
+
+
+def remove(file_path):
+    if os.path.exists(file_path):
+        os.remove(file_path)
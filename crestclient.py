@@ -0,0 +1,127 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import jsonbackend
+import metrics
+
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 0.5
+MAX_BACKOFF = 60.0
+DEFAULT_POOL_SIZE = 16
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class CrestError(Exception):
+    """
+    Raised when a CREST endpoint could not be fetched, after any retries.
+    """
+    def __init__(self, message, url, status_code=None):
+        Exception.__init__(self, "{message}: {url}".format(message=message, url=url))
+        self.url = url
+        self.status_code = status_code
+
+
+def decode(data, url):
+    """
+    Decodes the json body of a response from url. Raises a CrestError if it
+    is not json, as when a proxy answers with an error page or the body was
+    cut short.
+    """
+    try:
+        return jsonbackend.loads(data)
+    except ValueError as e:
+        raise CrestError("Invalid json in response ({error})".format(error=e), url)
+
+
+class RateLimiter(object):
+    """
+    Spaces requests out so that no more than requests_per_second are started,
+    across all threads sharing the limiter.
+    """
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            start_time = max(now, self.next_time)
+            self.next_time = start_time + self.interval
+        if start_time > now:
+            time.sleep(start_time - now)
+
+
+class CrestClient(object):
+    """
+    Fetches json from CREST over a pooled keep-alive session. Connection errors,
+    timeouts and 429/5xx responses are retried with exponential backoff and
+    jitter, other failures raise a CrestError.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 requests_per_second=None, pool_size=DEFAULT_POOL_SIZE):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.rate_limiter = None
+        if requests_per_second:
+            self.rate_limiter = RateLimiter(requests_per_second)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.request_count = 0
+        self.retry_count = 0
+
+    def get_retry_delay(self, attempt, response=None):
+        if response is not None and "Retry-After" in response.headers:
+            try:
+                return min(float(response.headers["Retry-After"]), MAX_BACKOFF)
+            except ValueError:
+                pass
+        delay = min(self.backoff * (2 ** attempt), MAX_BACKOFF)
+        return random.uniform(delay / 2.0, delay)
+
+    def get(self, url):
+        return decode(self.get_data(url), url)
+
+    def get_data(self, url):
+        """
+        Returns the undecoded body of the response.
+        """
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.wait()
+            self.request_count += 1
+            metrics.count("http_requests")
+            response = None
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = CrestError("Request failed ({error})".format(error=e), url)
+            else:
+                if response.ok:
+                    metrics.count("http_bytes", len(response.content))
+                    return response.content
+                error = CrestError(
+                    "Server error {status} {reason}".format(status=response.status_code, reason=response.reason),
+                    url,
+                    response.status_code,
+                )
+                if response.status_code not in RETRY_STATUS_CODES:
+                    raise error
+
+            if attempt >= self.retries:
+                raise error
+            delay = self.get_retry_delay(attempt, response)
+            print "{error}, retrying in {delay:.1f}s".format(error=error, delay=delay)
+            self.retry_count += 1
+            metrics.count("http_retries")
+            time.sleep(delay)
+            attempt += 1
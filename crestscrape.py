@@ -1,195 +1,712 @@
+import bisect
+import heapq
+import itertools
 import json
-import os
+import Queue
 import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
-import requests
 import urlparse
 
-from geometry import Vector
+import cache
+import checkpoint
+import crestclient
+import jsonbackend
+import metrics
+import timeline
+from trajectory import Trajectory
 
-TIME_UNITS_PER_SECOND = 10000000.0
+FRAME_QUEUE_SIZE = 64
+RESOURCE_WORKERS = 8
+FIRING_EFFECTS = ("effects.ProjectileFired", "effects.MissileDeployment")
+# Used for ammo whose graphic id has no graphic file.
+DEFAULT_AMMO_GRAPHIC_ID = "20043"
+# How long, in seconds, an effect is remembered after it started.
+EFFECT_WINDOW = 60.0
+# The parts of a scene dict that parsing the frames adds to, which checkpoints
+# store as they grow instead of with the static scene data.
+ACTOR_KINDS = ("ships", "drones")
+EVENT_TRACKS = ("projectiles", "removed_ships", "added_drones", "removed_drones")
+PARSED_KEYS = ACTOR_KINDS + EVENT_TRACKS
 
-def fetch_json_from_endpoint(crest_request, target_url):
+response_cache = None
+crest_client = None
+
+
+def get_response_cache():
+    global response_cache
+    if response_cache is None:
+        response_cache = cache.PackCache()
+    return response_cache
+
+
+def set_response_cache(new_cache):
+    global response_cache
+    response_cache = new_cache
+
+
+def get_crest_client():
+    global crest_client
+    if crest_client is None:
+        crest_client = crestclient.CrestClient()
+    return crest_client
+
+
+def set_crest_client(new_client):
+    global crest_client
+    crest_client = new_client
+
+
+def get_cache_key(target_url):
+    # Everything after the scheme, so that urls with a port do not collide.
+    return target_url.split(":", 1)[1].replace("/", "_").replace(":", "_")
+
+
+def fetch_data_from_endpoint(crest_request, target_url, refresh=False):
     """
-    Fetches the json data from the crest endpoint.
-    Stores them in a cache on disk.
+    Fetches the undecoded json data from the crest endpoint, using the shared
+    client if crest_request is None.
+    Stores them in the response cache. With refresh set, the cached copy is
+    ignored and replaced.
+    Raises a CrestError if the endpoint can not be fetched or its response is
+    not json.
     """
-    file_name = target_url.split(":")[1].replace("/", "_")
-    file_path = os.path.join("cache", file_name)
-    if not os.path.exists("cache"):
-        os.mkdir("cache")
-
-    if os.path.exists(file_path):
-        with open(file_path, 'r') as f:
-            return json.loads(f.read())
+    key = get_cache_key(target_url)
+    json_cache = get_response_cache()
+    if not refresh:
+        with metrics.stage("cache_read"):
+            data = json_cache.get(key)
+        if data is not None:
+            metrics.count("cache_hits")
+            return data
+        metrics.count("cache_misses")
 
     if "/eve/graphics/" in target_url:
         target_url = target_url.replace("/eve/graphics/", "/graphicids/")
     print "Fetching", target_url
-    response = crest_request.get(target_url)
-    if not response.ok:
-        print "Server error:", response.status_code, response.reason
-        sys.exit(1)
-    result = response.json()
-    with open(file_path, 'w') as f:
-        f.write(json.dumps(result))
+    if crest_request is None:
+        crest_request = get_crest_client()
+    with metrics.stage("network"):
+        data = crest_request.get_data(target_url)
+    # Only bodies that decode are cached, a bad one would fail every later run.
+    crestclient.decode(data, target_url)
+    with metrics.stage("cache_write"):
+        json_cache.put(key, data)
+
+    return data
+
+
+def fetch_json_from_endpoint(crest_request, target_url, refresh=False):
+    return jsonbackend.loads(fetch_data_from_endpoint(crest_request, target_url, refresh))
+
+
+def fetch_frame(crest_request, target_url, refresh=False):
+    return decode_frame(fetch_data_from_endpoint(crest_request, target_url, refresh))
 
-    return result
+
+static_resources = cache.StaticResourceCache(lambda url, client: fetch_json_from_endpoint(client, url))
+
+
+def fetch_static_resource(target_url, crest_request=None):
+    """
+    Fetches resources that never change during a match, such as types and
+    graphic ids, decoding each of them only once per process.
+    """
+    return static_resources.resolve(target_url, crest_request)
 
 
 def get_str_id_from_href(href):
     return href.split("/")[-2]
 
 
-def get_physics_data_from_frame(frame):
-    results = []
-    ship_data = frame["blueTeamShipData"] + frame["redTeamShipData"]
-    for d in ship_data:
-        ship_id = get_str_id_from_href(d["itemRef"]["href"])
-        if "physicsData" not in d:
-            continue
-        physics_data = d["physicsData"]
-        results.append((ship_id, [physics_data["x"], physics_data["y"], physics_data["z"]], [physics_data["vx"], physics_data["vy"], physics_data["vz"]]))
-    return results
-
-
-def get_effect_data_from_frame(frame):
-        results = []
-        ship_data = frame["blueTeamShipData"] + frame["redTeamShipData"]
-        for d in ship_data:
-            ship_id = get_str_id_from_href(d["itemRef"]["href"])
-            if "effects" not in d:
-                continue
-            effects = d["effects"]
-            results.append((ship_id, effects))
-        return results
+class FrameRecord(object):
+    """
+    The parts of a replay frame that the parser uses.
+    physics_data holds (ship_id, position, velocity) for each ship.
+    effect_data holds (ship_id, effects) for each ship that fired, with the
+    firing effects as (guid, start_time, target_id, graphic_id, module_ids).
+    drone_data holds (ship_id, drones) for each ship with drones out, with the
+    drones as (item_id, position, velocity, type_href).
+    """
+    __slots__ = ("time_str", "next_frame_href", "physics_data", "effect_data", "drone_data")
+
+    def __init__(self, time_str, next_frame_href, physics_data, effect_data, drone_data):
+        self.time_str = time_str
+        self.next_frame_href = next_frame_href
+        self.physics_data = physics_data
+        self.effect_data = effect_data
+        self.drone_data = drone_data
+
+
+def decode_frame(data):
+    """
+    Decodes the json of a replay frame into a FrameRecord, in a single pass
+    over the ships of both teams.
+    """
+    with metrics.stage("frame_decode"):
+        return _decode_frame(data)
 
 
-def get_drone_data_from_frame(frame):
-    results = []
-    ship_data = frame["blueTeamShipData"] + frame["redTeamShipData"]
-    for d in ship_data:
+def _decode_frame(data):
+    frame = jsonbackend.loads(data)
+    physics_data = []
+    effect_data = []
+    drone_data = []
+    for d in itertools.chain(frame["blueTeamShipData"], frame["redTeamShipData"]):
         ship_id = get_str_id_from_href(d["itemRef"]["href"])
-        if "drones" not in d:
-            continue
-        drones = d["drones"]
-        results.append((ship_id, drones))
-    return results
+        if "physicsData" in d:
+            p = d["physicsData"]
+            physics_data.append((ship_id, [p["x"], p["y"], p["z"]], [p["vx"], p["vy"], p["vz"]]))
+        if "effects" in d:
+            effects = []
+            for effect in d["effects"]:
+                if effect["guid"] not in FIRING_EFFECTS:
+                    continue
+                effects.append((
+                    effect["guid"],
+                    effect["startTime"],
+                    str(effect["targetID_str"]),
+                    get_str_id_from_href(effect["ammoGraphicResource"]["href"]),
+                    [module["moduleID_str"] for module in effect["modules"]],
+                ))
+            effect_data.append((ship_id, effects))
+        if "drones" in d:
+            drones = []
+            for drone in d["drones"]:
+                p = drone["physicsData"]
+                drones.append((
+                    str(drone["itemID"]),
+                    [p["x"], p["y"], p["z"]],
+                    [p.get("vx", 0.0), p.get("vy", 0.0), p.get("vz", 0.0)],
+                    drone["type"]["href"],
+                ))
+            drone_data.append((ship_id, drones))
+    next_frame_href = None
+    if "nextFrame" in frame:
+        next_frame_href = frame["nextFrame"]["href"]
+    return FrameRecord(frame["time_str"], next_frame_href, physics_data, effect_data, drone_data)
+
+
+class ReplayIndex(object):
+    """
+    The href and time of every replay frame of a match that has been crawled,
+    in frame order, so that frames can be found by number or time without
+    following the nextFrame links. next_href is the href of the frame after
+    the last one indexed, None once the end of the replay has been reached.
+    """
+    def __init__(self, next_href, hrefs=None, ticks=None):
+        self.next_href = next_href
+        self.hrefs = hrefs or []
+        # Absolute CREST times.
+        self.ticks = ticks or []
+
+    def __len__(self):
+        return len(self.hrefs)
+
+    def is_complete(self):
+        return self.next_href is None
+
+    def add(self, frame):
+        """
+        Adds the frame at next_href.
+        """
+        self.hrefs.append(self.next_href)
+        self.ticks.append(int(frame.time_str))
+        self.next_href = frame.next_frame_href
+
+    def find_window(self, start_tick, end_tick=None):
+        """
+        Returns the range of frame numbers with times from start_tick up to
+        and including end_tick.
+        """
+        first = bisect.bisect_left(self.ticks, start_tick)
+        if end_tick is None:
+            return first, len(self.ticks)
+        return first, bisect.bisect_right(self.ticks, end_tick)
+
+    def to_json(self):
+        return json.dumps({"next_href": self.next_href, "hrefs": self.hrefs, "ticks": self.ticks})
+
+    @classmethod
+    def from_json(cls, data):
+        index = json.loads(data)
+        return cls(index["next_href"], index["hrefs"], index["ticks"])
+
+
+def get_replay_index_key(target_url):
+    return get_cache_key(target_url) + ".frames"
+
+
+def load_replay_index(target_url):
+    """
+    Returns the replay index stored in the response cache for a match, or None.
+    """
+    data = get_response_cache().get(get_replay_index_key(target_url))
+    if data is None:
+        return None
+    return ReplayIndex.from_json(data)
+
+
+def save_replay_index(target_url, replay_index):
+    get_response_cache().put(get_replay_index_key(target_url), replay_index.to_json())
 
 
-def get_graphic_file_from_graphic_id(base_url, graphic_id_str):
+def build_replay_index(target_url, first_frame_href, crest_request=None):
+    """
+    Returns the complete replay index of a match, following the nextFrame
+    links from wherever the stored index ends, without parsing the frames.
+    The index is stored in the response cache, also when crawling fails
+    halfway.
+    """
+    replay_index = load_replay_index(target_url)
+    if replay_index is None:
+        replay_index = ReplayIndex(first_frame_href)
+    if replay_index.is_complete():
+        return replay_index
+    print "Indexing replay frames"
+    try:
+        while not replay_index.is_complete():
+            replay_index.add(fetch_frame(crest_request, replay_index.next_href))
+    finally:
+        save_replay_index(target_url, replay_index)
+    return replay_index
+
+
+def get_graphic_id_url(base_url, graphic_id_str):
     path = "/graphicids/%s/" % graphic_id_str
-    target_url = urlparse.urljoin(base_url, path)
-    graphic_id_data = fetch_json_from_endpoint(requests, target_url)
+    return urlparse.urljoin(base_url, path)
+
+
+def get_graphic_file_from_graphic_id(base_url, graphic_id_str, crest_request=None):
+    target_url = get_graphic_id_url(base_url, graphic_id_str)
+    graphic_id_data = fetch_static_resource(target_url, crest_request)
     return graphic_id_data["graphicFile"]
 
 
+def get_resource_urls_from_frame(base_url, frame):
+    """
+    Returns the urls of the static resources (drone types and ammo graphic ids)
+    that parsing this frame will look up.
+    """
+    urls = set()
+    for ship_id, effects in frame.effect_data:
+        for guid, start_time, target_id, graphic_id, module_ids in effects:
+            urls.add(get_graphic_id_url(base_url, graphic_id))
+    for ship_id, drones in frame.drone_data:
+        for item_id, position, velocity, type_href in drones:
+            urls.add(type_href)
+    return urls
+
+
+class FrameCrawler(object):
+    """
+    Follows the nextFrame links of a replay in a background thread and hands
+    the frames over, in order, through a bounded queue. The static resources
+    that each frame refers to are fetched by a small thread pool, so that they
+    are already in the cache by the time the frame gets parsed.
+    """
+    _END = object()
+
+    def __init__(self, crest_base_url, first_frame, crest_request, workers=RESOURCE_WORKERS, queue_size=FRAME_QUEUE_SIZE):
+        self.crest_base_url = crest_base_url
+        self.crest_request = crest_request
+        self.first_frame = first_frame
+        self.workers = workers
+        self.frames = Queue.Queue(maxsize=queue_size)
+        self.requested_urls = set()
+        self.pool = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.frame_count = 0
+        self.fetch_time = 0.0
+        self.wait_time = 0.0
+
+    def start(self):
+        self.pool = ThreadPool(self.workers)
+        self.thread = threading.Thread(target=self._crawl, name="FrameCrawler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _prefetch_resources(self, frame):
+        for url in get_resource_urls_from_frame(self.crest_base_url, frame):
+            if url in self.requested_urls:
+                continue
+            self.requested_urls.add(url)
+            self.pool.apply_async(fetch_static_resource, (url, self.crest_request))
+
+    def _crawl(self):
+        frame = self.first_frame
+        try:
+            while not self.stopped.is_set():
+                self._prefetch_resources(frame)
+                self.frames.put(frame)
+                if frame.next_frame_href is None:
+                    break
+                fetch_start = time.time()
+                frame = fetch_frame(self.crest_request, frame.next_frame_href)
+                self.fetch_time += time.time() - fetch_start
+        except BaseException:
+            # Re-raised on the consuming thread, see __iter__.
+            self.frames.put(sys.exc_info())
+        self.frames.put(self._END)
+
+    def __iter__(self):
+        while True:
+            wait_start = time.time()
+            item = self.frames.get()
+            self.wait_time += time.time() - wait_start
+            if item is self._END:
+                break
+            if isinstance(item, tuple):
+                raise item[0], item[1], item[2]
+            self.frame_count += 1
+            yield item
+
+    def stop(self):
+        self.stopped.set()
+        # Keep draining so that the crawl thread is never stuck on a full queue.
+        while self.thread.is_alive():
+            try:
+                self.frames.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self.pool.close()
+        self.pool.join()
+
+
+class EffectIndex(object):
+    """
+    The firing effects that have been added to the scene, so that an effect
+    listed in several consecutive frames is only added once.
+    An effect is forgotten once it started more than window seconds before the
+    current frame, and effects that old are dropped as already seen, so the
+    index stays the same size however long the fight goes on.
+    """
+    def __init__(self, window=EFFECT_WINDOW):
+        self.window = timeline.to_ticks(window)
+        self.effects = set()
+        self.expiry_queue = []
+        self.horizon = None
+        self.duplicates_dropped = 0
+
+    def __len__(self):
+        return len(self.effects)
+
+    def expire(self, current_tick):
+        self.horizon = current_tick - self.window
+        while self.expiry_queue and self.expiry_queue[0][0] < self.horizon:
+            self.effects.discard(heapq.heappop(self.expiry_queue)[1])
+
+    def is_duplicate(self, effect, start_tick):
+        """
+        Returns True, and counts the effect as a duplicate, if it has been
+        added before.
+        """
+        if effect in self.effects or (self.horizon is not None and start_tick < self.horizon):
+            self.duplicates_dropped += 1
+            return True
+        return False
+
+    def add(self, effect, start_tick):
+        # Only once the effect is in the scene, so that an effect that failed
+        # to be added is tried again when it is listed in the next frame.
+        self.effects.add(effect)
+        heapq.heappush(self.expiry_queue, (start_tick, effect))
+
+
 class FrameParser(object):
-    def __init__(self, crest_base_url, first_frame, scene_dict):
+    def __init__(self, crest_base_url, first_frame, scene_dict, crest_request=None,
+                 checkpoint_path=None, checkpoint_interval=checkpoint.DEFAULT_CHECKPOINT_INTERVAL, first_frame_href=None,
+                 replay_index=None):
         self.crest_base_url = crest_base_url
+        self.crest_request = crest_request
         self.scene_dict = scene_dict
         self.first_frame = first_frame
-        self.effects_processed = []
+        self.first_frame_href = first_frame_href
+        # The href of the last frame parse_frames has finished, if known.
+        self.last_frame_href = None
+        # Parsed frames are added to the replay index, when there is one.
+        self.replay_index = replay_index
+        self.effect_index = EffectIndex()
         self.active_ships = set()
         self.active_drones = set()
-
-    def parse_frames(self, frame=None):
+        self.frame_index = 0
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_started = False
+        # The rows of each trajectory, and the frames of the replay index,
+        # that are in the checkpoint already, and the actors added since.
+        self.saved_rows = dict((kind, {}) for kind in ACTOR_KINDS)
+        self.saved_frames = 0
+        self.new_actors = []
+
+    def get_trajectories(self, kind):
+        if kind == "ships":
+            return self.scene_dict["ships"]
+        return self.scene_dict["drones"]["locations"]
+
+    def get_checkpoint_segment(self, next_frame_href):
+        """
+        Returns what has changed since the last checkpoint: the rows added to
+        the trajectories, the events added to the event tracks and the frames
+        added to the replay index. The active actors and the effect index are
+        stored whole, they only hold what is in the scene or the effect window.
+        """
+        segment = {
+            "next_frame_href": next_frame_href,
+            "frame_index": self.frame_index,
+            "effect_index": self.effect_index,
+            "active_ships": self.active_ships,
+            "active_drones": self.active_drones,
+            "events": dict((key, self.scene_dict[key].take_changes()) for key in EVENT_TRACKS),
+            "replay_frames": None,
+        }
+        # New actors come first and in the order they were added, so that
+        # restoring them leaves the dicts iterating in the same order.
+        actors = self.new_actors + [
+            (kind, actor_id) for kind in ACTOR_KINDS for actor_id in self.get_trajectories(kind)
+            if actor_id in self.saved_rows[kind]
+        ]
+        segment["rows"] = []
+        segment["drones"] = {}
+        for kind, actor_id in actors:
+            trajectory = self.get_trajectories(kind)[actor_id]
+            start = self.saved_rows[kind].get(actor_id)
+            if start == len(trajectory):
+                continue
+            segment["rows"].append((kind, actor_id, trajectory.tail(start or 0)))
+            self.saved_rows[kind][actor_id] = len(trajectory)
+            if kind == "drones":
+                segment["drones"][actor_id] = self.scene_dict["drones"][actor_id]
+        self.new_actors = []
+        if self.replay_index is not None:
+            segment["replay_frames"] = (self.replay_index.hrefs[self.saved_frames:],
+                                        self.replay_index.ticks[self.saved_frames:])
+            self.saved_frames = len(self.replay_index)
+        return segment
+
+    def restore_checkpoint(self, segments):
+        """
+        Rebuilds the parser state from the segments of a checkpoint.
+        """
+        self.scene_dict = create_scene_dict()
+        self.scene_dict.update(segments[0]["scene"])
+        if segments[0]["replay_frames"] is not None:
+            self.replay_index = ReplayIndex(None)
+        for segment in segments:
+            for kind, actor_id, rows in segment["rows"]:
+                trajectories = self.get_trajectories(kind)
+                if actor_id not in trajectories:
+                    trajectories[actor_id] = Trajectory()
+                    self.saved_rows[kind][actor_id] = 0
+                trajectories[actor_id].extend(rows)
+                self.saved_rows[kind][actor_id] += len(rows)
+            self.scene_dict["drones"].update(segment["drones"])
+            for key, changes in segment["events"].iteritems():
+                self.scene_dict[key].apply_changes(*changes)
+            if self.replay_index is not None:
+                hrefs, ticks = segment["replay_frames"]
+                self.replay_index.hrefs.extend(hrefs)
+                self.replay_index.ticks.extend(ticks)
+        last = segments[-1]
+        if self.replay_index is not None:
+            self.replay_index.next_href = last["next_frame_href"]
+            self.saved_frames = len(self.replay_index)
+        self.frame_index = last["frame_index"]
+        self.effect_index = last["effect_index"]
+        self.active_ships = last["active_ships"]
+        self.active_drones = last["active_drones"]
+        self.checkpoint_started = True
+
+    def frame_parsed(self, next_frame_href):
+        """
+        Called after each frame that has a next frame. Every
+        checkpoint_interval frames what is needed to carry on from
+        next_frame_href is added to the checkpoint, which the first
+        checkpoint starts with the static scene data.
+        """
+        if self.checkpoint_path is None or not self.checkpoint_interval:
+            return
+        if self.frame_index % self.checkpoint_interval == 0:
+            segment = self.get_checkpoint_segment(next_frame_href)
+            if self.checkpoint_started:
+                checkpoint.append(self.checkpoint_path, segment)
+            else:
+                segment["scene"] = dict((key, value) for key, value in self.scene_dict.iteritems()
+                                        if key not in PARSED_KEYS)
+                checkpoint.save(self.checkpoint_path, segment)
+                self.checkpoint_started = True
+
+    def parse_frames(self, frame=None, frame_href=None):
         if not frame:
             frame = self.first_frame
+            frame_href = self.first_frame_href
 
         while True:
             self.parse_frame(frame, self.scene_dict)
-            try:
-                frame = fetch_json_from_endpoint(requests, frame["nextFrame"]["href"])
-            except KeyError:
+            if frame_href is not None:
+                self.last_frame_href = frame_href
+            next_frame_href = frame.next_frame_href
+            if next_frame_href is None:
                 break
+            self.frame_parsed(next_frame_href)
+            frame = fetch_frame(self.crest_request, next_frame_href)
+            frame_href = next_frame_href
+
+    def parse_new_frames(self):
+        """
+        Fetches the last parsed frame again, bypassing the cache, and parses
+        any frames that have been added after it since.
+        Returns the number of new frames.
+        """
+        frame = fetch_frame(self.crest_request, self.last_frame_href, refresh=True)
+        if frame.next_frame_href is None:
+            return 0
+        frame_count = self.frame_index
+        next_frame_href = frame.next_frame_href
+        next_frame = fetch_frame(self.crest_request, next_frame_href)
+        self.parse_frames(next_frame, next_frame_href)
+        return self.frame_index - frame_count
+
+    def parse_indexed_frames(self, hrefs, workers=RESOURCE_WORKERS):
+        """
+        Parses the frames at hrefs in order, fetching them concurrently
+        instead of following their nextFrame links.
+        """
+        pool = ThreadPool(max(workers, 1))
+        try:
+            for frame in pool.imap(lambda href: fetch_frame(self.crest_request, href), hrefs):
+                self.parse_frame(frame, self.scene_dict)
+        finally:
+            pool.close()
+            pool.join()
+
+    def crawl_frames(self, frame=None, workers=RESOURCE_WORKERS):
+        """
+        Like parse_frames, but the frames and the resources they refer to are
+        fetched concurrently while earlier frames are being parsed.
+        """
+        if not frame:
+            frame = self.first_frame
 
-    def parse_effects(self, ship_id, effects, scene_dict, current_time):
-        projectile_dict = scene_dict["projectiles"]
-        for effect in effects:
-            firing_effects = ("effects.ProjectileFired", "effects.MissileDeployment")
-            if effect["guid"] in firing_effects:
-                start_time = (effect["startTime"] / TIME_UNITS_PER_SECOND) - scene_dict["start_time"]
-                target_id = str(effect["targetID_str"])
-                graphic_id = get_str_id_from_href(effect["ammoGraphicResource"]["href"])
-
-                comparable_tuple = (effect["guid"], start_time, graphic_id, ship_id, target_id)
-                if comparable_tuple in self.effects_processed:
-                    continue
-                try:
-                    ammo_graphic_resource = get_graphic_file_from_graphic_id(self.crest_base_url, graphic_id)
-                except KeyError:
-                    print "Graphic id", graphic_id, "not found, using default."
-                    ammo_graphic_resource = get_graphic_file_from_graphic_id(self.crest_base_url, "20043")
-                if start_time not in projectile_dict:
-                    projectile_dict[start_time] = []
-                slots = []
-                for module in effect["modules"]:
-                    module_id = module["moduleID_str"]
-                    slots.append(scene_dict[ship_id]["turret_module_id_to_slot"][module_id])
-
-
-                self.effects_processed.append(comparable_tuple)
-
-                projectile_dict[start_time].append({
-                  "source_id": str(ship_id),
-                  "target_id": target_id,
-                  "slots": slots,
-                  "ammo_graphic_resource": ammo_graphic_resource,
-                })
-
-    def update_active_ships(self, ships_this_frame, scene_dict, current_time):
+        crawler = FrameCrawler(self.crest_base_url, frame, self.crest_request, workers)
+        crawler.start()
+        start = time.time()
+        parse_time = 0.0
+        try:
+            for frame in crawler:
+                parse_start = time.time()
+                self.parse_frame(frame, self.scene_dict)
+                if frame.next_frame_href is not None:
+                    self.frame_parsed(frame.next_frame_href)
+                parse_time += time.time() - parse_start
+        finally:
+            crawler.stop()
+        total_time = time.time() - start
+        print "Crawled %d frames in %.2fs (%.1f frames/s)" % (
+            crawler.frame_count, total_time, crawler.frame_count / max(total_time, 1e-6))
+        print "  fetching frames: %.2fs, parsing: %.2fs, parser waiting on network: %.2fs" % (
+            crawler.fetch_time, parse_time, crawler.wait_time)
+
+    def parse_effects(self, ship_id, effects, scene_dict, current_tick, resources):
+        projectiles = scene_dict["projectiles"]
+        for guid, effect_start_time, target_id, graphic_id, module_ids in effects:
+            start_tick = int(effect_start_time) - scene_dict["start_tick"]
+
+            comparable_tuple = (guid, start_tick, graphic_id, ship_id, target_id)
+            if self.effect_index.is_duplicate(comparable_tuple, start_tick):
+                continue
+            graphic_id_data = resources[get_graphic_id_url(self.crest_base_url, graphic_id)]
+            if "graphicFile" not in graphic_id_data:
+                print "Graphic id", graphic_id, "not found, using default."
+                graphic_id_data = resources[get_graphic_id_url(self.crest_base_url, DEFAULT_AMMO_GRAPHIC_ID)]
+            ammo_graphic_resource = graphic_id_data["graphicFile"]
+            slots = []
+            for module_id in module_ids:
+                slots.append(scene_dict[ship_id]["turret_module_id_to_slot"][module_id])
+
+            projectiles.add(start_tick, {
+              "source_id": str(ship_id),
+              "target_id": target_id,
+              "slots": slots,
+              "ammo_graphic_resource": ammo_graphic_resource,
+            })
+            self.effect_index.add(comparable_tuple, start_tick)
+
+    def update_active_ships(self, ships_this_frame, scene_dict, current_tick):
         removed_ships = self.active_ships - ships_this_frame
         self.active_ships = ships_this_frame
         if not removed_ships:
             return
-        scene_dict["removed_ships"][current_time] = list(removed_ships)
+        scene_dict["removed_ships"].add(current_tick, list(removed_ships))
 
-    def update_active_drones(self, drones_this_frame, scene_dict, current_time):
+    def update_active_drones(self, drones_this_frame, scene_dict, current_tick):
         added_drones = drones_this_frame - self.active_drones
         removed_drones = self.active_drones - drones_this_frame
         self.active_drones = drones_this_frame
-        scene_dict["removed_drones"][current_time] = list(removed_drones)
-        scene_dict["added_drones"][current_time] = list(added_drones)
+        # Added every frame, even when empty, so that every frame gets a sleep.
+        scene_dict["removed_drones"].add(current_tick, list(removed_drones))
+        scene_dict["added_drones"].add(current_tick, list(added_drones))
 
-    def parse_drones(self, ship_id, drones, scene_dict, current_time, found_drones):
-        for drone in drones:
-            item_id = str(drone["itemID"])
-            physics_data = drone["physicsData"]
+    def parse_drones(self, ship_id, drones, scene_dict, current_tick, found_drones, resources):
+        for item_id, position, velocity, type_href in drones:
             if item_id not in found_drones:
                 found_drones.add(item_id)
             if item_id not in scene_dict["drones"]:
                 scene_dict["drones"][item_id] = {}
             if item_id not in scene_dict["drones"]["locations"]:
-                scene_dict["drones"]["locations"][item_id] = {}
-            scene_dict["drones"]["locations"][item_id][current_time] = {
-                "location": Vector(physics_data["x"], physics_data["y"], physics_data["z"]),
-            }
-            scene_dict["drones"][item_id]["type_data"] = fetch_json_from_endpoint(requests, drone["type"]["href"])
+                scene_dict["drones"]["locations"][item_id] = Trajectory()
+                self.new_actors.append(("drones", item_id))
+            scene_dict["drones"]["locations"][item_id].append(self.frame_index, current_tick, position, velocity)
+            scene_dict["drones"][item_id]["type_data"] = resources[type_href]
+            scene_dict["drones"][item_id]["owner"] = ship_id
+
+    def resolve_resources(self, frame):
+        """
+        Fetches the static resources a frame refers to before any of it is
+        parsed, so that failing to fetch one leaves the parser and the scene
+        dict as they were, and the frame can be parsed again by the next poll
+        or retry. Returns the resources by url.
+        """
+        resources = {}
+        for url in get_resource_urls_from_frame(self.crest_base_url, frame):
+            resources[url] = fetch_static_resource(url, self.crest_request)
+            if "/graphicids/" in url and "graphicFile" not in resources[url]:
+                default_url = get_graphic_id_url(self.crest_base_url, DEFAULT_AMMO_GRAPHIC_ID)
+                resources[default_url] = fetch_static_resource(default_url, self.crest_request)
+        return resources
 
     def parse_frame(self, frame, scene_dict):
-        t = (int(frame["time_str"])/ TIME_UNITS_PER_SECOND) - scene_dict["start_time"]
+        resources = self.resolve_resources(frame)
+        with metrics.stage("parse"):
+            self._parse_frame(frame, scene_dict, resources)
+        if self.replay_index is not None:
+            self.replay_index.add(frame)
+        metrics.count("frames")
+
+    def _parse_frame(self, frame, scene_dict, resources):
+        tick = int(frame.time_str) - scene_dict["start_tick"]
         found_ships = set()
-        physics_data = get_physics_data_from_frame(frame)
 
-        for ship_id, ship_position, ship_velocity in physics_data:
+        for ship_id, ship_position, ship_velocity in frame.physics_data:
             found_ships.add(ship_id)
             if ship_id not in scene_dict["ships"]:
-                scene_dict["ships"][ship_id] = {}
-            scene_dict["ships"][ship_id][t] = {
-                "location": Vector(*ship_position),
-            }
-        self.update_active_ships(found_ships, scene_dict, t)
+                scene_dict["ships"][ship_id] = Trajectory()
+                self.new_actors.append(("ships", ship_id))
+            scene_dict["ships"][ship_id].append(self.frame_index, tick, ship_position, ship_velocity)
+        self.update_active_ships(found_ships, scene_dict, tick)
 
-        effect_data = get_effect_data_from_frame(frame)
-        for ship_id, effects in effect_data:
-            self.parse_effects(ship_id, effects, scene_dict, t)
+        self.effect_index.expire(tick)
+        for ship_id, effects in frame.effect_data:
+            self.parse_effects(ship_id, effects, scene_dict, tick, resources)
 
-        drone_data = get_drone_data_from_frame(frame)
         found_drones = set()
-        for ship_id, drones in drone_data:
-            self.parse_drones(ship_id, drones, scene_dict, t, found_drones)
-        self.update_active_drones(found_drones, scene_dict, t)
+        for ship_id, drones in frame.drone_data:
+            self.parse_drones(ship_id, drones, scene_dict, tick, found_drones, resources)
+        self.update_active_drones(found_drones, scene_dict, tick)
+        self.frame_index += 1
 
 
 def get_scene_name_from_match_json(match_json):
@@ -249,36 +766,108 @@ def get_base_url(full_url):
     return "{scheme}://{netloc}".format(scheme=parse_result.scheme, netloc=parse_result.netloc)
 
 
-def get_scene_dict(target_url):
-    scene_dict = {
+def get_match_urls(target_url, crest_request=None):
+    """
+    Returns the urls of all the matches under a tournament, series or match
+    endpoint, or in a collection of any of those, in the order they are listed.
+    """
+    data = fetch_json_from_endpoint(crest_request, target_url)
+    if "firstReplayFrame" in data:
+        return [target_url]
+
+    match_urls = []
+    if "items" in data:
+        for item in data["items"]:
+            match_urls.extend(get_match_urls(item["href"], crest_request))
+        if "next" in data:
+            match_urls.extend(get_match_urls(data["next"]["href"], crest_request))
+    elif "matches" in data:
+        match_urls.extend(get_match_urls(data["matches"]["href"], crest_request))
+    elif "series" in data:
+        match_urls.extend(get_match_urls(data["series"]["href"], crest_request))
+    return match_urls
+
+
+def resolve_static_resources(pool, urls, crest_request=None):
+    """
+    Fetches the static resources at urls on the thread pool, each of them
+    once, and returns them by url.
+    """
+    urls = sorted(set(urls))
+    resources = pool.map(lambda url: fetch_static_resource(url, crest_request), urls)
+    return dict(zip(urls, resources))
+
+
+def create_scene_dict():
+    """
+    Returns a scene dict without any static scene data or parsed frames.
+    """
+    return {
         "ships": {},
-        "projectiles": {},
-        "removed_ships": {},
+        "projectiles": timeline.EventTrack(),
+        "removed_ships": timeline.EventTrack(),
         "drones": {"locations": {}},
-        "added_drones": {},
-        "removed_drones": {},
+        "added_drones": timeline.EventTrack(),
+        "removed_drones": timeline.EventTrack(),
     }
-    match_json = fetch_json_from_endpoint(requests, target_url)
+
+
+def load_static_scene_data(target_url, crest_request=None, workers=RESOURCE_WORKERS):
+    """
+    Sets up a scene dict with the ships, their turrets and the match timing.
+    Returns it together with the first replay frame.
+    The first and last replay frames, and then the types and graphic
+    resources the ships use, are fetched concurrently by up to workers
+    threads, so that setting up takes about as long as the slowest request
+    of each round.
+    """
+    scene_dict = create_scene_dict()
+    match_json = fetch_json_from_endpoint(crest_request, target_url)
     crest_base_url = get_base_url(target_url)
 
     scene_dict["scene_name"] =  get_scene_name_from_match_json(match_json)
 
     if "staticSceneData" not in match_json:
-        print "Static scene data does not exist on the server. Unable to create scene."
-        sys.exit(1)
-    
-    staticSceneData = fetch_json_from_endpoint(requests, match_json["staticSceneData"]["href"])
-    ships = staticSceneData["ships"]
+        raise crestclient.CrestError("Static scene data does not exist on the server, unable to create scene", target_url)
+
+    pool = ThreadPool(max(workers, 1))
+    try:
+        first_frame = pool.apply_async(fetch_frame, (crest_request, match_json["firstReplayFrame"]["href"]))
+        last_frame = pool.apply_async(fetch_frame, (crest_request, match_json["lastReplayFrame"]["href"]))
+        staticSceneData = fetch_json_from_endpoint(crest_request, match_json["staticSceneData"]["href"])
+        ships = staticSceneData["ships"]
+
+        with metrics.stage("static_resources"):
+            urls = []
+            for ship in ships:
+                urls.append(ship["type"]["href"])
+                urls.extend(turret["graphicResource"]["href"] for turret in ship["turrets"])
+            resources = resolve_static_resources(pool, urls, crest_request)
+            # Types without a sofDNA are drawn with the graphic file of their
+            # graphic id, which is only known once the type has been fetched.
+            urls = []
+            for ship in ships:
+                graphic_id = resources[ship["type"]["href"]]["graphicID"]
+                if "sofDNA" not in graphic_id:
+                    urls.append(get_graphic_id_url(crest_base_url, graphic_id["id_str"]))
+            resources.update(resolve_static_resources(pool, urls, crest_request))
+
+        firstReplayFrame = first_frame.get()
+        lastReplayFrame = last_frame.get()
+    finally:
+        pool.close()
+        pool.join()
     scene_dict["nebula_name"] = staticSceneData["nebulaName"]
+    scene_dict["first_frame_href"] = match_json["firstReplayFrame"]["href"]
 
     for ship in ships:
         ship_url = ship["item"]["href"]
         ship_item_id = get_str_id_from_href(ship_url)
-        type_data = fetch_json_from_endpoint(requests, ship["type"]["href"])
+        type_data = resources[ship["type"]["href"]]
         try:
             respath = str(type_data["graphicID"]["sofDNA"])
         except KeyError:
-            respath = get_graphic_file_from_graphic_id(crest_base_url, type_data["graphicID"]["id_str"])
+            respath = resources[get_graphic_id_url(crest_base_url, type_data["graphicID"]["id_str"])]["graphicFile"]
         race = respath.split(":")[-1]
         radius = type_data["radius"]
 
@@ -296,19 +885,84 @@ def get_scene_dict(target_url):
         scene_dict[ship_item_id]["turrets"] = {}
         scene_dict[ship_item_id]["turret_module_id_to_slot"] = {}
         for turret in ship["turrets"]:
-            graphic_resource_data = fetch_json_from_endpoint(requests, turret["graphicResource"]["href"])
+            graphic_resource_data = resources[turret["graphicResource"]["href"]]
             respath = graphic_resource_data["graphicFile"]
             module_id = get_str_id_from_href(turret["href"])
             scene_dict[ship_item_id]["turret_module_id_to_slot"][module_id] = slot
             scene_dict[ship_item_id]["turrets"][slot] = respath
             slot += 1
 
-    firstReplayFrame = fetch_json_from_endpoint(requests, match_json["firstReplayFrame"]["href"])
-    lastReplayFrame = fetch_json_from_endpoint(requests, match_json["lastReplayFrame"]["href"])
-    scene_dict["start_time"] = int(firstReplayFrame["time_str"]) / TIME_UNITS_PER_SECOND
-    scene_dict["end_time"] = int(lastReplayFrame["time_str"]) / TIME_UNITS_PER_SECOND
-    scene_dict["duration"] = scene_dict["end_time"] - scene_dict["start_time"]
+    # Absolute CREST times, the times in the scene dict are ticks since start_tick.
+    scene_dict["start_tick"] = int(firstReplayFrame.time_str)
+    scene_dict["end_tick"] = int(lastReplayFrame.time_str)
+    scene_dict["duration"] = timeline.to_seconds(scene_dict["end_tick"] - scene_dict["start_tick"])
+
+    return scene_dict, firstReplayFrame
+
+
+def get_window_scene_dict(target_url, start, end=None, workers=RESOURCE_WORKERS, crest_request=None):
+    """
+    Builds the scene dict for the part of a match from start up to end
+    seconds after the first replay frame, parsing only the frames in between.
+    The times are rebased to the first frame of the window, where the ships
+    and drones that are around at that point start out.
+    """
+    scene_dict, first_frame = load_static_scene_data(target_url, crest_request, workers)
+    replay_index = build_replay_index(target_url, scene_dict["first_frame_href"], crest_request)
+    end_tick = None
+    if end is not None:
+        end_tick = scene_dict["start_tick"] + timeline.to_ticks(end)
+    first, last = replay_index.find_window(scene_dict["start_tick"] + timeline.to_ticks(start), end_tick)
+    if first >= last:
+        raise crestclient.CrestError("The replay has no frames between {start:g}s and {end}".format(
+            start=start, end="the end" if end is None else "%gs" % end), target_url)
+
+    print "Parsing frames", first, "to", last - 1, "of", len(replay_index)
+    scene_dict["window"] = (start, end)
+    scene_dict["start_tick"] = replay_index.ticks[first]
+    scene_dict["end_tick"] = replay_index.ticks[last - 1]
+    scene_dict["duration"] = timeline.to_seconds(scene_dict["end_tick"] - scene_dict["start_tick"])
+    frame_parser = FrameParser(get_base_url(target_url), None, scene_dict, crest_request)
+    frame_parser.parse_indexed_frames(replay_index.hrefs[first:last], workers)
+    print "Static resources:", static_resources.stats()
+    return frame_parser.scene_dict
+
+
+def get_scene_dict(target_url, pipelined=False, workers=RESOURCE_WORKERS, crest_request=None,
+                   checkpoint_folder=None, checkpoint_interval=checkpoint.DEFAULT_CHECKPOINT_INTERVAL):
+    """
+    Builds the scene dict for a match. With a checkpoint_folder, the parser
+    state is saved there every checkpoint_interval frames, and a conversion
+    that was interrupted carries on from its last checkpoint.
+    The frames are indexed while they are parsed, see get_window_scene_dict.
+    """
+    crest_base_url = get_base_url(target_url)
+    checkpoint_path = None
+    segments = None
+    if checkpoint_folder is not None:
+        checkpoint_path = checkpoint.get_checkpoint_path(checkpoint_folder, get_cache_key(target_url))
+        segments = checkpoint.load(checkpoint_path)
+
+    if segments is not None:
+        print "Resuming from frame", segments[-1]["frame_index"]
+        first_frame = fetch_frame(crest_request, segments[-1]["next_frame_href"])
+        frame_parser = FrameParser(crest_base_url, first_frame, None, crest_request, checkpoint_path, checkpoint_interval)
+        frame_parser.restore_checkpoint(segments)
+    else:
+        scene_dict, first_frame = load_static_scene_data(target_url, crest_request, workers)
+        frame_parser = FrameParser(crest_base_url, first_frame, scene_dict, crest_request, checkpoint_path, checkpoint_interval,
+                                   replay_index=ReplayIndex(scene_dict["first_frame_href"]))
 
-    frame_parser = FrameParser(crest_base_url, firstReplayFrame, scene_dict)
-    frame_parser.parse_frames()
-    return scene_dict
+    if pipelined:
+        frame_parser.crawl_frames(workers=workers)
+    else:
+        frame_parser.parse_frames()
+    if checkpoint_path is not None:
+        checkpoint.remove(checkpoint_path)
+    save_replay_index(target_url, frame_parser.replay_index)
+    print "Static resources:", static_resources.stats()
+    print "Duplicate effects dropped:", frame_parser.effect_index.duplicates_dropped
+    metrics.count("static_resource_hits", static_resources.hits)
+    metrics.count("static_resource_misses", static_resources.misses)
+    metrics.count("duplicate_effects_dropped", frame_parser.effect_index.duplicates_dropped)
+    return frame_parser.scene_dict
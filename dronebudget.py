@@ -0,0 +1,217 @@
+# Caps the number of drone actors in a scene, since every drone gets its own
+# actor and curves, which makes drone heavy matches slow to load and play back.
+# The drones are ranked by relevance, and the least relevant ones are merged
+# into one actor per flight, the drones of a type launched by the same ship,
+# or left out.
+from collections import OrderedDict
+
+import numpy
+
+import timeline
+from trajectory import Trajectory
+
+MERGE = "merge"
+CULL = "cull"
+MODES = (MERGE, CULL)
+# A drone this far from the middle of the ships, in meters, counts half as
+# much as one right in it.
+FIGHT_DISTANCE_SCALE = 10000.0
+
+
+class DroneBudget(object):
+    """
+    The most drone actors a scene may have, and whether the drones over the
+    budget are merged into flights or culled.
+    """
+    def __init__(self, max_drones, mode=MERGE):
+        self.max_drones = max_drones
+        self.mode = mode
+
+    def merges(self):
+        return self.mode == MERGE
+
+
+def get_fight_centers(ships):
+    """
+    Returns the sorted frames that ships were seen in and the mean position
+    of the ships in each of them.
+    """
+    trajectories = [trajectory for trajectory in ships.itervalues() if len(trajectory)]
+    if not trajectories:
+        return numpy.empty(0, numpy.int64), numpy.empty((0, 3))
+    frames = numpy.concatenate([trajectory.frames for trajectory in trajectories])
+    positions = numpy.concatenate([trajectory.positions for trajectory in trajectories])
+    fight_frames, inverse = numpy.unique(frames, return_inverse=True)
+    return fight_frames, mean_by_group(positions, inverse)
+
+
+def mean_by_group(values, groups):
+    counts = numpy.bincount(groups).astype(numpy.float64)
+    return numpy.column_stack([
+        numpy.bincount(groups, weights=values[:, axis]) for axis in range(values.shape[1])
+    ]) / counts[:, numpy.newaxis]
+
+
+def get_relevance(scene_dict):
+    """
+    Scores every drone by how long it is out, how often it is shot at and how
+    close it stays to the ships. Returns a dict of drone id to score.
+    """
+    fight_frames, fight_centers = get_fight_centers(scene_dict["ships"])
+    times_targeted = {}
+    for firing in scene_dict["projectiles"].events:
+        times_targeted[firing["target_id"]] = times_targeted.get(firing["target_id"], 0) + 1
+
+    relevance = {}
+    for drone_id, trajectory in scene_dict["drones"]["locations"].iteritems():
+        if len(trajectory) == 0:
+            relevance[drone_id] = 0.0
+            continue
+        # A second is added so that drones seen only once still rank by distance.
+        seconds_out = timeline.to_seconds(trajectory.ticks[-1] - trajectory.ticks[0]) + 1.0
+        distance = 0.0
+        if len(fight_frames):
+            nearest = numpy.searchsorted(fight_frames, trajectory.frames).clip(0, len(fight_frames) - 1)
+            distance = numpy.sqrt(((trajectory.positions - fight_centers[nearest]) ** 2).sum(axis=1)).mean()
+        relevance[drone_id] = seconds_out * (1 + times_targeted.get(drone_id, 0)) / (1.0 + distance / FIGHT_DISTANCE_SCALE)
+    return relevance
+
+
+def get_flight(scene_dict, drone_id):
+    drone = scene_dict["drones"][drone_id]
+    return drone.get("owner"), drone["type_data"]["graphicID"]["sofDNA"]
+
+
+def plan_budget(ranked_drones, flights, drone_budget):
+    """
+    Splits the drones, most relevant first, into the ones that keep their own
+    actor and, when merging, the flights the others are merged into, so that
+    there are at most max_drones actors. Flights are ordered by their most
+    relevant drone, and the least relevant ones are left out when even the
+    flights do not fit.
+    Returns the kept drones and an OrderedDict of flight to drones.
+    """
+    max_drones = drone_budget.max_drones
+    kept_count = min(max_drones, len(ranked_drones))
+    while True:
+        merged = OrderedDict()
+        if drone_budget.merges():
+            for drone_id in ranked_drones[kept_count:]:
+                merged.setdefault(flights[drone_id], []).append(drone_id)
+        if kept_count + len(merged) <= max_drones or kept_count == 0:
+            break
+        kept_count -= 1
+    merged = OrderedDict(merged.items()[:max_drones - kept_count])
+    return ranked_drones[:kept_count], merged
+
+
+def merge_trajectories(trajectories):
+    """
+    Returns a trajectory through the mean position and velocity of the given
+    trajectories at each frame that any of them has.
+    """
+    frames = numpy.concatenate([trajectory.frames for trajectory in trajectories])
+    ticks = numpy.concatenate([trajectory.ticks for trajectory in trajectories])
+    positions = numpy.concatenate([trajectory.positions for trajectory in trajectories])
+    velocities = numpy.concatenate([trajectory.velocities for trajectory in trajectories])
+    merged_frames, first, inverse = numpy.unique(frames, return_index=True, return_inverse=True)
+    return Trajectory.from_arrays(merged_frames, ticks[first], mean_by_group(positions, inverse),
+                                  mean_by_group(velocities, inverse))
+
+
+def replace_drone_events(added_drones, removed_drones, replacements):
+    """
+    Maps the drones in the add and remove events to the actors that stand in
+    for them, dropping the drones without one. An actor standing in for
+    several drones is added with the first of them and removed with the last.
+    Returns the new added_drones and removed_drones tracks.
+    """
+    added = timeline.EventTrack()
+    removed = timeline.EventTrack()
+    drones_out = {}
+    # At the same tick the adds come first, so that a flight whose drones
+    # come and go at once stays in the scene.
+    events = timeline.merge(
+        ((tick, (added, drone_ids)) for tick, drone_ids in added_drones),
+        ((tick, (removed, drone_ids)) for tick, drone_ids in removed_drones),
+    )
+    for tick, (track, drone_ids) in events:
+        change = 1 if track is added else -1
+        actors = []
+        for drone_id in drone_ids:
+            actor = replacements.get(drone_id)
+            if actor is None:
+                continue
+            count = drones_out.get(actor, 0)
+            drones_out[actor] = max(count + change, 0)
+            if (change > 0 and count == 0) or (change < 0 and count <= 1):
+                actors.append(actor)
+        # Kept even when empty, so that every frame still gets a sleep.
+        track.add(tick, actors)
+    return added, removed
+
+
+def retarget_projectiles(projectiles, replacements, drone_ids):
+    """
+    Points the shots at drones to the actors that stand in for them, and
+    drops the shots at drones that were left out.
+    """
+    retargeted = timeline.EventTrack()
+    for tick, firing in projectiles:
+        target_id = firing["target_id"]
+        if target_id in drone_ids:
+            if target_id not in replacements:
+                continue
+            if replacements[target_id] != target_id:
+                firing = dict(firing, target_id=replacements[target_id])
+        retargeted.add(tick, firing)
+    return retargeted
+
+
+def apply_drone_budget(scene_dict, drone_budget):
+    """
+    Brings the drones of the scene dict within the budget. A merged flight
+    takes the id of its most relevant drone.
+    Returns an OrderedDict with the number of drones kept, merged and culled,
+    and of the flights they were merged into.
+    """
+    locations = scene_dict["drones"]["locations"]
+    result = OrderedDict((("kept", len(locations)), ("merged", 0), ("flights", 0), ("culled", 0)))
+    if len(locations) <= drone_budget.max_drones:
+        return result
+
+    relevance = get_relevance(scene_dict)
+    ranked_drones = sorted(locations, key=lambda drone_id: (-relevance[drone_id], drone_id))
+    flights = dict((drone_id, get_flight(scene_dict, drone_id)) for drone_id in ranked_drones)
+    kept, merged = plan_budget(ranked_drones, flights, drone_budget)
+
+    replacements = dict((drone_id, drone_id) for drone_id in kept)
+    for drone_ids in merged.itervalues():
+        for drone_id in drone_ids:
+            replacements[drone_id] = drone_ids[0]
+        locations[drone_ids[0]] = merge_trajectories([locations[drone_id] for drone_id in drone_ids])
+    all_drones = set(locations)
+    # Deleting keeps the order the remaining drones are added to the scene in.
+    for drone_id in ranked_drones:
+        if replacements.get(drone_id) != drone_id:
+            del locations[drone_id]
+
+    scene_dict["added_drones"], scene_dict["removed_drones"] = replace_drone_events(
+        scene_dict["added_drones"], scene_dict["removed_drones"], replacements
+    )
+    scene_dict["projectiles"] = retarget_projectiles(scene_dict["projectiles"], replacements, all_drones)
+
+    result["kept"] = len(kept)
+    result["merged"] = sum(len(drone_ids) for drone_ids in merged.itervalues())
+    result["flights"] = len(merged)
+    result["culled"] = len(ranked_drones) - result["kept"] - result["merged"]
+    return result
+
+
+def estimate_playback_cost(scene_dict):
+    """
+    Returns the number of actors in the scene and the number of replay
+    samples in their curves.
+    """
+    trajectories = scene_dict["ships"].values() + scene_dict["drones"]["locations"].values()
+    return len(trajectories), sum(len(trajectory) for trajectory in trajectories)
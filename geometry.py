@@ -1,5 +1,7 @@
 import math
 
+import numpy
+
 class Vector(object):
     def __init__(self, x, y, z):
         self.x = x
@@ -43,3 +45,29 @@ class Vector(object):
 
     def __repr__(self):
         return "[{x}, {y}, {z}]".format(x=self.x, y=self.y, z=self.z)
+
+
+def normalize_vectors(vectors):
+    """
+    Normalizes each row of an (n, 3) array. Zero length rows become [1, 0, 0],
+    like Vector.normalize does.
+    """
+    vectors = numpy.asarray(vectors, dtype=numpy.float64)
+    lengths = numpy.sqrt(vectors[:, 0] ** 2 + vectors[:, 1] ** 2 + vectors[:, 2] ** 2)
+    zero_length = lengths == 0.0
+    lengths[zero_length] = 1.0
+    normalized = vectors / lengths[:, numpy.newaxis]
+    normalized[zero_length] = [1.0, 0.0, 0.0]
+    return normalized
+
+
+def vectors_to_yaw_pitch_roll(vectors):
+    """
+    The array version of Vector.to_yaw_pitch_roll, returns an array each for
+    yaw, pitch and roll.
+    """
+    nv = normalize_vectors(vectors)
+    pitch = numpy.arcsin(-nv[:, 1])
+    yaw = numpy.arctan2(nv[:, 0], nv[:, 2])
+    roll = numpy.zeros(len(nv), dtype=numpy.int64)
+    return yaw, pitch, roll
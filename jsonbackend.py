@@ -0,0 +1,19 @@
+# Replay frames are decoded with the fastest json library that is installed,
+# falling back to the standard library.
+try:
+    import ujson
+
+    def loads(data):
+        # Without precise_float ujson can round the last digit of a float
+        # differently from the standard library.
+        return ujson.loads(data, precise_float=True)
+
+    BACKEND = "ujson"
+except ImportError:
+    try:
+        import simplejson as json
+        BACKEND = "simplejson"
+    except ImportError:
+        import json
+        BACKEND = "json"
+    loads = json.loads
@@ -0,0 +1,206 @@
+import argparse
+import os
+import sys
+import time
+
+import crestclient
+import crestscrape
+import main
+import probe
+import red
+import timeline
+
+DESCRIPTION = "Converts a match while it is still being played, polling CREST \
+for new replay frames and refreshing the scene files as they arrive."
+
+DEFAULT_POLL_INTERVAL = 10.0
+DEFAULT_IDLE_TIMEOUT = 600.0
+EVENT_KEYS = ("projectiles", "removed_ships", "added_drones", "removed_drones")
+
+
+def replace_file(temp_path, file_path):
+    try:
+        os.rename(temp_path, file_path)
+    except OSError:
+        # Windows will not rename over an existing file.
+        os.remove(file_path)
+        os.rename(temp_path, file_path)
+
+
+def update_curve_extent(red_file, actor_id, trajectory):
+    """
+    Stretches the curves of an actor to the end of its trajectory, with the
+    same lengths and end values initialize_actor_red_file gives them.
+    """
+    start_time = trajectory.times[0].item()
+    end_time = trajectory.times[-1].item()
+    vector_curve = red_file.get_vector_curve(actor_id)
+    vector_curve.length = end_time - start_time
+    vector_curve.end_value = trajectory.end_location()
+
+    start_direction = trajectory.get_location(1) - trajectory.get_location(0)
+    end_direction = trajectory.end_location() - trajectory.get_location(len(trajectory) - 2)
+    start_values = start_direction.to_yaw_pitch_roll()
+    end_values = end_direction.to_yaw_pitch_roll()
+    rotation = red_file.get_euler_rotation(actor_id)
+    for curve, start_value, end_value in zip((rotation.yaw, rotation.pitch, rotation.roll), start_values, end_values):
+        curve.length = end_time - start_time
+        curve.start_value = start_value
+        curve.end_value = end_value
+
+
+class LiveConversion(object):
+    """
+    Converts a match that is still in progress. The frame parser is kept
+    between polls and picks up where the frame chain ended, and only the keys
+    and timed events of the new frames are generated. Keys that have been
+    generated are kept formatted, so refreshing the files only writes them out
+    again.
+    """
+    def __init__(self, target_url, save_folder, ship_to_follow, crest_request=None):
+        self.target_url = target_url
+        self.save_folder = save_folder
+        self.ship_to_follow = ship_to_follow
+        self.crest_request = crest_request
+        self.frame_parser = None
+        self.scene_save_path = None
+        self.red_save_path = None
+        self.red_file = red.RedFile()
+        self.actor_commands = probe.SceneFile(ship_to_follow)
+        self.event_commands = probe.SceneFile(ship_to_follow)
+        # How many rows of each actor's trajectory already have keys.
+        self.keyed_rows = {}
+
+    def start(self):
+        scene_dict, first_frame = crestscrape.load_static_scene_data(self.target_url, self.crest_request)
+        match_json = crestscrape.fetch_json_from_endpoint(self.crest_request, self.target_url)
+        self.frame_parser = crestscrape.FrameParser(
+            crestscrape.get_base_url(self.target_url), first_frame, scene_dict, self.crest_request,
+            first_frame_href=match_json["firstReplayFrame"]["href"],
+        )
+        self.scene_save_path, self.red_save_path = main.get_save_paths(self.save_folder, scene_dict["scene_name"])
+
+    def poll(self):
+        """
+        Parses the frames added since the last poll, adds their keys and
+        events and refreshes the files.
+        Returns the number of new frames.
+        """
+        if self.frame_parser is None:
+            self.start()
+        if self.frame_parser.frame_index == 0:
+            self.frame_parser.parse_frames()
+            frame_count = self.frame_parser.frame_index
+        else:
+            frame_count = self.frame_parser.parse_new_frames()
+        if not frame_count:
+            return 0
+
+        scene_dict = self.frame_parser.scene_dict
+        for ship_id, trajectory in scene_dict["ships"].iteritems():
+            if ship_id not in self.keyed_rows:
+                main.initialize_ship_scene_file(scene_dict, self.actor_commands, ship_id)
+            self.add_keys(actor_id=ship_id, trajectory=trajectory)
+        for drone_id, trajectory in scene_dict["drones"]["locations"].iteritems():
+            if drone_id not in self.keyed_rows:
+                main.initialize_drone_scene_file(scene_dict, self.actor_commands, drone_id)
+            self.add_keys(actor_id=drone_id, trajectory=trajectory)
+
+        # The event tracks only ever hold the events of the frames parsed since
+        # the last poll.
+        main.add_timed_events(scene_dict, self.event_commands)
+        for key in EVENT_KEYS:
+            scene_dict[key] = timeline.EventTrack()
+
+        if scene_dict["ships"]:
+            self.save(scene_dict)
+        return frame_count
+
+    def add_keys(self, actor_id, trajectory):
+        keyed_rows = self.keyed_rows.get(actor_id, 0)
+        if keyed_rows == len(trajectory):
+            return
+        if keyed_rows == 0:
+            main.initialize_actor_red_file(trajectory, self.red_file, actor_id)
+            vector_curve = self.red_file.get_vector_curve(actor_id)
+            vector_curve.keys = [red.FormattedKeys(vector_curve.keys)]
+            rotation = self.red_file.get_euler_rotation(actor_id)
+            for curve in (rotation.yaw, rotation.pitch, rotation.roll):
+                curve.scalar_keys = [red.FormattedKeys(curve.scalar_keys)]
+        else:
+            # The rotation keys of a row face along the displacement from the
+            # row before it, so that row is generated again and its own keys
+            # are dropped.
+            new_keys = red.RedFile()
+            main.initialize_actor_red_file(trajectory.tail(keyed_rows - 1), new_keys, actor_id)
+            self.red_file.get_vector_curve(actor_id).keys.append(
+                red.FormattedKeys(new_keys.get_vector_curve(actor_id).keys[1:])
+            )
+            rotation = self.red_file.get_euler_rotation(actor_id)
+            new_rotation = new_keys.get_euler_rotation(actor_id)
+            for curve, new_curve in zip((rotation.yaw, rotation.pitch, rotation.roll),
+                                        (new_rotation.yaw, new_rotation.pitch, new_rotation.roll)):
+                curve.scalar_keys.append(red.FormattedKeys(new_curve.scalar_keys[2:]))
+            update_curve_extent(self.red_file, actor_id, trajectory)
+        self.keyed_rows[actor_id] = len(trajectory)
+
+    def save(self, scene_dict):
+        """
+        Writes both files next to their targets and renames them into place,
+        the curves first so that the scene never refers to missing curves.
+        """
+        scene_file = probe.SceneFile(self.ship_to_follow)
+        main.create_scene_file_header(scene_dict, scene_file, self.ship_to_follow)
+        scene_file.data["commands"].extend(self.actor_commands.data["commands"])
+        main.bind_curves(scene_dict, scene_file)
+        main.wait_for_loads(scene_file)
+        scene_file.data["commands"].extend(self.event_commands.data["commands"])
+
+        self.red_file.save(self.red_save_path + ".tmp")
+        replace_file(self.red_save_path + ".tmp", self.red_save_path)
+        scene_file.save(self.scene_save_path + ".tmp")
+        replace_file(self.scene_save_path + ".tmp", self.scene_save_path)
+
+    def watch(self, poll_interval=DEFAULT_POLL_INTERVAL, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        """
+        Polls for new frames until none have arrived for idle_timeout seconds.
+        Failed polls are reported and tried again at the next interval.
+        """
+        last_update = time.time()
+        while True:
+            try:
+                frame_count = self.poll()
+            except crestclient.CrestError as e:
+                print e
+                frame_count = 0
+            if frame_count:
+                print "Added {count} frames, {total} in total".format(count=frame_count, total=self.frame_parser.frame_index)
+                last_update = time.time()
+            elif time.time() - last_update > idle_timeout:
+                print "No new frames for {timeout:.0f} seconds, stopping".format(timeout=idle_timeout)
+                return
+            time.sleep(poll_interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("target_url", help="The url that points to the tournament match endpoint")
+    parser.add_argument("save_folder", help="A directory in which to save the generated scene data", default=".", nargs="?")
+    parser.add_argument("-f", "--follow", help="The item-id of a ship that the camera should follow ", default=None, nargs="?")
+    parser.add_argument("-i", "--interval", help="Seconds to wait between polls for new frames", default=DEFAULT_POLL_INTERVAL, type=float)
+    parser.add_argument("--idle-timeout", help="Stop once no new frames have arrived for this many seconds", default=DEFAULT_IDLE_TIMEOUT, type=float)
+    main.add_client_arguments(parser)
+    main.add_cache_arguments(parser)
+    args = parser.parse_args()
+    main.check_cache_arguments(parser, args)
+    main.open_response_cache(args)
+    main.create_crest_client(args)
+    live_conversion = LiveConversion(args.target_url, args.save_folder, args.follow)
+    try:
+        live_conversion.start()
+        live_conversion.watch(args.interval, args.idle_timeout)
+    except KeyboardInterrupt:
+        print "Stopped"
+    except crestclient.CrestError as e:
+        print e
+        sys.exit(1)
@@ -1,22 +1,38 @@
 import argparse
+import cProfile
+import json
 import os
+import pstats
+import sys
 
+import numpy
+
+import archive
+import cache
+import checkpoint
+import crestclient
 import crestscrape
+import dronebudget
 import geometry
+import metrics
 import red
 import probe
+import simplify
+import timeline
 
 DESCRIPTION= "A tool to generate EveProbe scene files from alliance tournament \
 data that is fetched through public CREST."
 
+SHIP_REMOVAL_DELAY = timeline.to_ticks(0.1)
+# Passed as a ship to follow, adds a camera following each ship.
+FOLLOW_EVERY_SHIP = "all"
+
 
 def get_starting_camera_position_and_interest(scene_dict):
     ships_counted = 0
     accumulation_vector = geometry.Vector(0.0, 0.0, 0.0)
     for ship_id in scene_dict["ships"]:
-        ship_dict = scene_dict["ships"][ship_id]
-        first = min(ship_dict.keys())
-        accumulation_vector = ship_dict[first]["location"]
+        accumulation_vector = scene_dict["ships"][ship_id].start_location()
         ships_counted += 1
     interest =  accumulation_vector / ships_counted
     position = interest - geometry.Vector(1000.0, 0.0, 0.0)
@@ -40,62 +56,150 @@ def fit_turrets_to_ship(scene_dict, scene_file, ship_id):
         scene_file.fit_turret_to_actor(ship_id, respath, slot)
 
 
-def initialize_actor_red_file(actor_dict, red_file, ship_id):
-    frames = sorted(actor_dict.keys())
-    start_time = frames[0]
-    end_time = frames[-1]
-
-    start_pos = actor_dict[start_time]["location"]
-    end_pos = actor_dict[end_time]["location"]
+class CurveOptions(object):
+    """
+    How the replay samples of each actor are turned into curve keys.
+    position_tolerance and angle_tolerance enable simplification, see
+    simplify.simplify_track. smooth derives hermite tangents from the
+    velocities, and sample_interval only keeps a key every so many seconds,
+    which implies smooth.
+    """
+    def __init__(self, position_tolerance=None, angle_tolerance=None, smooth=False, sample_interval=None):
+        self.position_tolerance = position_tolerance
+        self.angle_tolerance = angle_tolerance
+        self.smooth = smooth or sample_interval is not None
+        self.sample_interval = sample_interval
+
+    def reduces_keys(self):
+        return self.position_tolerance is not None or self.sample_interval is not None
+
+    def keys_per_sample(self):
+        # A location key, and one rotation key facing along the velocity or
+        # two facing along the displacement.
+        if self.smooth:
+            return 2
+        return 3
+
+
+def fill_missing_velocities(times, positions, velocities):
+    """
+    Returns the velocities with the rows that are all zero, as they are for
+    drones reported without one, replaced by the rate of change of the
+    positions, so that those keys face along the displacement.
+    """
+    missing = ~velocities.any(axis=1)
+    if len(times) < 2 or not missing.any():
+        return velocities
+    velocities = velocities.copy()
+    velocities[missing] = numpy.gradient(positions, times, axis=0)[missing]
+    return velocities
+
+
+def initialize_actor_red_file(trajectory, red_file, ship_id, curve_options=None):
+    """
+    Adds the location and rotation curves of an actor, picking and shaping the
+    keys according to the curve options.
+    Returns the number of samples in the track and the number of keys used.
+    """
+    if curve_options is None:
+        curve_options = CurveOptions()
+    frame_times = trajectory.times
+    frame_positions = trajectory.positions
+    frame_velocities = trajectory.velocities
+    sample_count = len(frame_times)
+    kept = numpy.arange(sample_count)
+    if curve_options.sample_interval is not None:
+        kept = simplify.sample_track(frame_times, curve_options.sample_interval)
+    if curve_options.position_tolerance is not None:
+        kept = kept[simplify.simplify_track(
+            frame_times[kept], frame_positions[kept], curve_options.position_tolerance, curve_options.angle_tolerance
+        )]
+    if len(kept) < sample_count:
+        frame_times = frame_times[kept]
+        frame_positions = frame_positions[kept]
+        frame_velocities = frame_velocities[kept]
+
+    times = frame_times.tolist()
+    positions = [geometry.Vector(*position) for position in frame_positions.tolist()]
+    start_time = times[0]
+    end_time = times[-1]
+
+    start_pos = positions[0]
+    end_pos = positions[-1]
+
+    if curve_options.smooth:
+        # Hermite keys with the velocities as tangents, and rotation keys
+        # facing along the velocity at every key.
+        frame_velocities = fill_missing_velocities(frame_times, frame_positions, frame_velocities)
+        start_velocity = geometry.Vector(*frame_velocities[0].tolist())
+        end_velocity = geometry.Vector(*frame_velocities[-1].tolist())
+        interpolation = red.INTERPOLATION_HERMITE
+        red_file.add_vector_curve(ship_id, 0.0, (end_time - start_time), start_pos, end_pos,
+                                  start_velocity.to_list(), end_velocity.to_list(), interpolation)
+        red_file.add_rotation_curve(ship_id, 0.0, (end_time - start_time), start_velocity, end_velocity, interpolation)
+        red_file.add_vector_keys(ship_id, positions, times, frame_velocities)
+        red_file.add_rotation_keys(ship_id, frame_velocities, frame_times, hermite=True)
+        return sample_count, len(times)
 
     red_file.add_vector_curve(ship_id, 0.0, (end_time - start_time), start_pos, end_pos)
-    if len(frames) > 1:
-        start_direction = actor_dict[frames[1]]["location"] - actor_dict[frames[0]]["location"]
-        end_direction = actor_dict[frames[-1]]["location"] - actor_dict[frames[-2]]["location"]
+    if len(times) > 1:
+        start_direction = positions[1] - positions[0]
+        end_direction = positions[-1] - positions[-2]
     else:
         start_direction = end_direction = geometry.Vector(0.0, 0.0, 0.0)
     red_file.add_rotation_curve(ship_id, 0.0, (end_time - start_time), start_direction, end_direction)
 
+    red_file.add_vector_keys(ship_id, positions, times)
 
-    last_time = start_time
-    for time in frames:
-        red_file.add_vector_key(ship_id, actor_dict[time]["location"], time)
-        playback_velocity = actor_dict[time]["location"] - actor_dict[last_time]["location"]
-        rotation_time = 0.001
-        red_file.add_rotation_key(ship_id, playback_velocity, last_time + rotation_time / 2.0)
-        red_file.add_rotation_key(ship_id, playback_velocity, time - rotation_time / 2.0)
-        last_time = time
+    # Each frame gets two rotation keys facing along the displacement since the
+    # previous frame, just after the previous frame and just before this one.
+    rotation_time = 0.001
+    previous_times = numpy.concatenate((frame_times[:1], frame_times[:-1]))
+    displacements = numpy.diff(frame_positions, axis=0)
+    displacements = numpy.concatenate((numpy.zeros((1, 3)), displacements))
+    rotation_times = numpy.column_stack((previous_times + rotation_time / 2.0, frame_times - rotation_time / 2.0))
+    red_file.add_rotation_keys(ship_id, numpy.repeat(displacements, 2, axis=0), rotation_times.ravel().tolist())
+    return sample_count, len(times)
 
 
 def initialize_ship_scene_file(scene_dict, scene_file, ship_id):
-    ship_dict = scene_dict["ships"][ship_id]
-    frames = sorted(ship_dict.keys())
-    start_time = frames[0]
-    ship_position = ship_dict[start_time]["location"]
+    ship_position = scene_dict["ships"][ship_id].start_location()
     scene_file.add_actor(ship_id, scene_dict[ship_id]["respath"])
     scene_file.set_actor_position(ship_id, ship_position)
 
     fit_turrets_to_ship(scene_dict, scene_file, ship_id)
 
 def initialize_drone_scene_file(scene_dict, scene_file, drone_id):
-    location_dict = scene_dict["drones"]["locations"][drone_id]
-    frames = sorted(location_dict.keys())
-    start_time = frames[0]
-    start_position = location_dict[start_time]["location"]
+    start_position = scene_dict["drones"]["locations"][drone_id].start_location()
     scene_file.add_command(["actor", drone_id, str(scene_dict["drones"][drone_id]["type_data"]["graphicID"]["sofDNA"])])
     scene_file.set_actor_position(drone_id, start_position)
 
 
-def add_initial_scene_data(scene_dict, scene_file, red_file):
+def add_initial_scene_data(scene_dict, scene_file, red_file, curve_options=None):
+    actors = []
     for ship_id in scene_dict["ships"]:
         initialize_ship_scene_file(scene_dict, scene_file, ship_id)
-        actor_dict = scene_dict["ships"][ship_id]
-        initialize_actor_red_file(actor_dict, red_file, ship_id)
+        actors.append((ship_id, scene_dict["ships"][ship_id]))
     for drone_id in scene_dict["drones"]["locations"]:
         initialize_drone_scene_file(scene_dict, scene_file, drone_id)
-        actor_dict = scene_dict["drones"]["locations"][drone_id]
-        initialize_actor_red_file(actor_dict, red_file, drone_id)
+        actors.append((drone_id, scene_dict["drones"]["locations"][drone_id]))
+
+    total_samples = 0
+    total_keys = 0
+    for actor_id, trajectory in actors:
+        sample_count, key_count = initialize_actor_red_file(trajectory, red_file, actor_id, curve_options)
+        red_file.finish_curve_set(actor_id)
+        total_samples += sample_count
+        total_keys += key_count
+        if curve_options is not None and curve_options.reduces_keys():
+            print "  {actor_id}: {samples} -> {keys} keys".format(actor_id=actor_id, samples=sample_count, keys=key_count)
+    if curve_options is not None and curve_options.reduces_keys():
+        print "Reduced curves from {samples} to {keys} keys".format(samples=total_samples, keys=total_keys)
 
+    bind_curves(scene_dict, scene_file)
+
+
+def bind_curves(scene_dict, scene_file):
     scene_name = scene_dict["scene_name"]
     scene_file.add_command(["bind_matching_dynamics", "res:/curves/{scene_name}.red".format(scene_name=scene_name)])
 
@@ -105,91 +209,362 @@ def wait_for_loads(scene_file):
     scene_file.add_command(["wait_for_loads"])
 
 
+def get_fire_events(scene_dict):
+    for tick, firing_dict in scene_dict["projectiles"]:
+        source = firing_dict["source_id"]
+        target = firing_dict["target_id"]
+        ammo_graphic_resource = firing_dict["ammo_graphic_resource"]
+        yield tick, [["fire", source, slot, target, 0.0, ammo_graphic_resource] for slot in firing_dict["slots"]]
+
+
+def get_explosion_events(scene_dict):
+    for tick, actors in scene_dict["removed_ships"]:
+        yield tick, [
+            ["explosion_for_actor", "explosion", scene_dict[actor]["explosion"]["path"], actor, scene_dict[actor]["explosion"]["scale"]]
+            for actor in actors
+        ]
+
+
+def get_ship_removal_events(scene_dict):
+    # Ships are removed just after they explode.
+    for tick, actors in scene_dict["removed_ships"]:
+        yield tick + SHIP_REMOVAL_DELAY, [["remove_actor", actor] for actor in actors]
+
+
+def get_drone_events(scene_dict, key, command):
+    for tick, drone_ids in scene_dict[key]:
+        yield tick, [[command, drone_id] for drone_id in drone_ids]
+
+
+def get_timed_events(scene_dict):
+    """
+    Merges the sorted event tracks of the scene dict into a single stream of
+    (tick, commands) pairs, in one pass.
+    """
+    return timeline.merge(
+        get_fire_events(scene_dict),
+        get_explosion_events(scene_dict),
+        get_ship_removal_events(scene_dict),
+        get_drone_events(scene_dict, "added_drones", "add_actor"),
+        get_drone_events(scene_dict, "removed_drones", "remove_actor"),
+    )
+
+
 def add_timed_events(scene_dict, scene_file):
-    timed_events = {}
-
-    effects_dict = scene_dict["projectiles"]
-    for time_frame in effects_dict:
-        for firing_dict in effects_dict[time_frame]:
-            source = firing_dict["source_id"]
-            target = firing_dict["target_id"]
-            slots = firing_dict["slots"]
-            ammo_graphic_resource = firing_dict["ammo_graphic_resource"]
-            if time_frame not in timed_events:
-                timed_events[time_frame] = []
-            for slot in slots:
-                timed_events[time_frame].append(["fire", source, slot, target, 0.0, ammo_graphic_resource])
-
-    ship_removal_dict = scene_dict["removed_ships"]
-
-    for time_frame in ship_removal_dict:
-        if time_frame not in timed_events:
-            timed_events[time_frame] = []
-        for actor in ship_removal_dict[time_frame]:
-            explosion_resource_path = scene_dict[actor]["explosion"]["path"]
-            explosion_scale = scene_dict[actor]["explosion"]["scale"]
-            timed_explosion = ["explosion_for_actor", "explosion", explosion_resource_path, actor, explosion_scale]
-            timed_removal = ["remove_actor", actor]
-            timed_events[time_frame].append(timed_explosion)
-            removal_time_frame = time_frame + 0.1
-            if removal_time_frame not in timed_events:
-                timed_events[removal_time_frame] = []
-            timed_events[removal_time_frame].append(timed_removal)
-
-    drone_addition_dict = scene_dict["added_drones"]
-    for time_frame in drone_addition_dict:
-        if time_frame not in timed_events:
-            timed_events[time_frame] = []
-        for drone_id in drone_addition_dict[time_frame]:
-            add_command = ["add_actor", drone_id]
-            timed_events[time_frame].append(add_command)
-
-    drone_removal_dict = scene_dict["removed_drones"]
-    for time_frame in drone_removal_dict:
-        if time_frame not in timed_events:
-            timed_events[time_frame] = []
-        for drone_id in drone_removal_dict[time_frame]:
-            removal_command = ["remove_actor", drone_id]
-            timed_events[time_frame].append(removal_command)
-
-    scene_file.add_timed_events(timed_events)
-
-
-def save(scene_file, red_file, save_folder, scene_name):
+    scene_file.add_timed_events(get_timed_events(scene_dict), timeline.TICKS_PER_SECOND)
+
+
+def make_folder(folder_path):
+    if not os.path.exists(folder_path):
+        try:
+            os.makedirs(folder_path)
+        except OSError:
+            # Created by another conversion running at the same time.
+            if not os.path.isdir(folder_path):
+                raise
+
+
+def get_save_paths(save_folder, scene_name):
     scene_save_folder_path = os.path.join(save_folder, "sequences")
     scene_save_path = os.path.join(scene_save_folder_path, "{scene_name}.yaml".format(scene_name=scene_name))
-    if not os.path.exists(scene_save_folder_path):
-        os.makedirs(scene_save_folder_path)
+    make_folder(scene_save_folder_path)
     red_save_folder_path = os.path.join(save_folder, "curves")
-    if not os.path.exists(red_save_folder_path):
-        os.mkdir(red_save_folder_path)
+    make_folder(red_save_folder_path)
     red_save_path = os.path.join(red_save_folder_path, "{scene_name}.red".format(scene_name=scene_name))
-    scene_file.save(scene_save_path)
-    red_file.save(red_save_path)
-
-
-def main(target_url, save_folder, ship_to_follow):
-    scene_file = probe.SceneFile(ship_to_follow)
-    red_file = red.RedFile()
-    print "Loading or fetching scene data"
-    scene_dict = crestscrape.get_scene_dict(target_url)
+    return scene_save_path, red_save_path
+
+
+def get_ships_to_follow(scene_dict, ships_to_follow):
+    """
+    Expands FOLLOW_EVERY_SHIP into the ids of all the ships, keeping the order
+    and dropping repeats. None stands for a camera that follows no ship.
+    """
+    if not ships_to_follow:
+        return [None]
+    expanded = []
+    for ship_to_follow in ships_to_follow:
+        if ship_to_follow == FOLLOW_EVERY_SHIP:
+            ship_ids = sorted(scene_dict["ships"])
+        else:
+            ship_ids = [ship_to_follow]
+        for ship_id in ship_ids:
+            if ship_id not in expanded:
+                expanded.append(ship_id)
+    return expanded
+
+
+def get_camera_scene_name(scene_name, ship_to_follow):
+    if ship_to_follow is None:
+        return "{scene_name} free camera".format(scene_name=scene_name)
+    return "{scene_name} follow {ship_id}".format(scene_name=scene_name, ship_id=ship_to_follow)
+
+
+def get_window_suffix(start, end):
+    if end is None:
+        return " from {start:g}s".format(start=start)
+    return " {start:g}-{end:g}s".format(start=start, end=end)
+
+
+def main(target_url, save_folder, ships_to_follow, pipelined=False, workers=crestscrape.RESOURCE_WORKERS,
+         curve_options=None, scene_name_suffix="", checkpoint_folder=None,
+         checkpoint_interval=checkpoint.DEFAULT_CHECKPOINT_INTERVAL, command_quantum=None, start=None, end=None,
+         archive_path=None, drone_budget=None):
+    """
+    Converts a match into a .red file and a scene file for each of the
+    ships_to_follow, see get_ships_to_follow. With more than one camera the
+    scene files are named after the ship they follow, and all of them use the
+    same curves.
+    With a start or an end, in seconds from the start of the match, only that
+    part of the match is converted, and the window is added to the scene name.
+    With an archive_path, the parsed match is read from that archive, or
+    saved there if there is none yet, see archive.save.
+    With a drone_budget, the least relevant drones are merged or culled to
+    keep within it, see dronebudget.apply_drone_budget.
+    """
+    window = None
+    if start is not None or end is not None:
+        window = (start or 0.0, end)
+    archived = None
+    if archive_path is not None:
+        with metrics.stage("archive_load"):
+            archived = archive.load(archive_path)
+        if archived is not None and archived[0] != target_url:
+            print "Ignoring archive of a different match", archive_path
+            archived = None
+        elif archived is not None and archived[1].get("window") != window:
+            print "Ignoring archive of a different part of the match", archive_path
+            archived = None
+    if archived is not None:
+        scene_dict = archived[1]
+        print "Using the parsed match from", archive_path
+    else:
+        print "Loading or fetching scene data"
+        with metrics.stage("scrape"):
+            if window is None:
+                scene_dict = crestscrape.get_scene_dict(
+                    target_url, pipelined, workers, checkpoint_folder=checkpoint_folder, checkpoint_interval=checkpoint_interval
+                )
+            else:
+                scene_dict = crestscrape.get_window_scene_dict(target_url, window[0], window[1], workers)
+        if archive_path is not None:
+            with metrics.stage("archive_save"):
+                archive.save(archive_path, scene_dict, target_url)
+            print "Saved the parsed replay to", archive_path
+    if drone_budget is not None:
+        with metrics.stage("drone_budget"):
+            before = dronebudget.estimate_playback_cost(scene_dict)
+            drones = dronebudget.apply_drone_budget(scene_dict, drone_budget)
+            after = dronebudget.estimate_playback_cost(scene_dict)
+        print_drone_budget(drones, before, after, curve_options or CurveOptions())
+    if window is not None:
+        scene_name_suffix += get_window_suffix(*window)
+    scene_dict["scene_name"] += scene_name_suffix
     scene_name = scene_dict["scene_name"]
     print "Generating scene for", scene_name
+    scene_save_path, red_save_path = get_save_paths(save_folder, scene_name)
+    # The curves are streamed to disk while the scene is being generated.
+    red_file = red.RedFile(red_save_path)
+
+    # Only the camera commands differ between the cameras, so the commands
+    # for the actors and the events are only generated once.
+    with metrics.stage("curves"):
+        actor_commands = probe.SceneFile(None)
+        add_initial_scene_data(scene_dict, actor_commands, red_file, curve_options)
+        wait_for_loads(actor_commands)
+    with metrics.stage("events"):
+        timed_events = list(get_timed_events(scene_dict))
+    with metrics.stage("save"):
+        red_file.close()
+
+    ships_to_follow = get_ships_to_follow(scene_dict, ships_to_follow)
+    render_cache = None
+    if len(ships_to_follow) > 1:
+        render_cache = probe.RenderCache()
+    for ship_to_follow in ships_to_follow:
+        scene_file = probe.SceneFile(ship_to_follow)
+        create_scene_file_header(scene_dict, scene_file, ship_to_follow)
+        camera_save_path = scene_save_path
+        if len(ships_to_follow) > 1:
+            camera_scene_name = get_camera_scene_name(scene_name, ship_to_follow)
+            scene_file.set_name(camera_scene_name)
+            camera_save_path = os.path.join(os.path.dirname(scene_save_path), camera_scene_name + ".yaml")
+            print "Generating camera", camera_scene_name
+        with metrics.stage("events"):
+            scene_file.data["commands"].extend(actor_commands.data["commands"])
+            scene_file.add_timed_events(timed_events, timeline.TICKS_PER_SECOND)
+        if command_quantum is not None:
+            print_optimization(scene_file.optimize(command_quantum))
+
+        print "Saving"
+        with metrics.stage("save"):
+            scene_file.save(camera_save_path, render_cache)
+        metrics.count("cameras")
+    print "Done"
+    return scene_name
 
-    create_scene_file_header(scene_dict, scene_file, ship_to_follow)
-    add_initial_scene_data(scene_dict, scene_file, red_file)
-    wait_for_loads(scene_file)
-    add_timed_events(scene_dict, scene_file)
 
-    print "Saving"
-    save(scene_file, red_file, save_folder, scene_name)
-    print "Done"
+def add_follow_arguments(parser):
+    parser.add_argument("-f", "--follow", help="The item-id of a ship that the camera should follow, or \"all\" for every ship. "
+                        "Repeat it to write a scene for each camera, -f on its own adds a camera that follows no ship",
+                        action="append", nargs="?")
+
+
+def positive_float(value):
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError("%s is not a positive number" % value)
+    return number
+
+
+def add_window_arguments(parser):
+    parser.add_argument("--start", help="Only convert the match from this many seconds after its start, using the stored frame index", default=None, type=float)
+    parser.add_argument("--end", help="Only convert the match up to this many seconds after its start", default=None, type=float)
+
+
+def add_curve_arguments(parser):
+    parser.add_argument("-s", "--simplify", help="Drop keys that are not needed to stay within the position and angle tolerances", action="store_true")
+    parser.add_argument("--position-tolerance", help="How far, in meters, a simplified curve may stray from the replay", default=simplify.DEFAULT_POSITION_TOLERANCE, type=positive_float)
+    parser.add_argument("--angle-tolerance", help="How far, in degrees, a simplified curve may turn away from the replay", default=simplify.DEFAULT_ANGLE_TOLERANCE, type=positive_float)
+    parser.add_argument("--smooth", help="Use the ship velocities as curve tangents instead of flying in straight lines between keys", action="store_true")
+    parser.add_argument("--sample-interval", help="Only emit a key every so many seconds, implies --smooth", default=None, type=positive_float)
+
+
+def get_curve_options(args):
+    curve_options = CurveOptions(smooth=args.smooth, sample_interval=args.sample_interval)
+    if args.simplify:
+        curve_options.position_tolerance = args.position_tolerance
+        curve_options.angle_tolerance = args.angle_tolerance
+    return curve_options
+
+
+def print_optimization(removed):
+    print "Removed {total} commands: {sleep} sleeps, {camera} camera commands and {fire} fire commands".format(
+        total=sum(removed.values()), **removed)
+
+
+def add_scene_arguments(parser):
+    parser.add_argument("--optimize", help="Merge short sleeps and drop redundant camera and fire commands before saving", action="store_true")
+    parser.add_argument("--time-quantum", help="With --optimize, the shortest sleep in seconds, events closer together are merged", default=probe.DEFAULT_TIME_QUANTUM, type=positive_float)
+
+
+def get_command_quantum(args):
+    if args.optimize:
+        return args.time_quantum
+    return None
+
+
+def add_drone_budget_arguments(parser):
+    parser.add_argument("--drone-budget", help="The most drone actors in the scene, the least relevant drones are merged or culled to keep within it", default=None, type=int)
+    parser.add_argument("--drone-lod", help="Whether the drones over the budget are merged into one actor per flight or culled", default=dronebudget.MERGE, choices=dronebudget.MODES)
+
+
+def get_drone_budget(args):
+    if args.drone_budget is None:
+        return None
+    return dronebudget.DroneBudget(args.drone_budget, args.drone_lod)
+
+
+def print_drone_budget(drones, before, after, curve_options):
+    print "Kept {kept} drones, merged {merged} into {flights} flights and culled {culled}".format(**drones)
+    print "Estimated playback cost: {actors} actors and {keys} curve keys, down from {actors_before} and {keys_before}".format(
+        actors=after[0], keys=after[1] * curve_options.keys_per_sample(),
+        actors_before=before[0], keys_before=before[1] * curve_options.keys_per_sample())
+    metrics.count("drones_merged", drones["merged"])
+    metrics.count("drones_culled", drones["culled"])
+
+
+def add_client_arguments(parser):
+    parser.add_argument("--timeout", help="Seconds to wait for a CREST response", default=crestclient.DEFAULT_TIMEOUT, type=float)
+    parser.add_argument("--retries", help="How many times failed or throttled requests are retried", default=crestclient.DEFAULT_RETRIES, type=int)
+    parser.add_argument("--rate-limit", help="The most requests per second to send to the CREST server", default=None, type=float)
+
+
+def create_crest_client(args):
+    crest_client = crestclient.CrestClient(args.timeout, args.retries, requests_per_second=args.rate_limit)
+    crestscrape.set_crest_client(crest_client)
+    return crest_client
+
+
+def add_checkpoint_arguments(parser):
+    parser.add_argument("--checkpoint-folder", help="Where to keep checkpoints for resuming interrupted conversions", default=checkpoint.DEFAULT_CHECKPOINT_FOLDER)
+    parser.add_argument("--checkpoint-interval", help="How many frames to parse between checkpoints, 0 to disable them", default=checkpoint.DEFAULT_CHECKPOINT_INTERVAL, type=int)
+
+
+def add_report_arguments(parser):
+    parser.add_argument("--report", help="Write the time spent in each stage and other statistics to this json file", default=None)
+    parser.add_argument("--profile", help="Profile the conversion and write the statistics to this file", default=None)
+
+
+def write_report(file_path):
+    with open(file_path, "w") as f:
+        json.dump(metrics.metrics.report(), f, indent=2)
+    print "Report written to", file_path
+
+
+def print_profile(profiler, file_path, limit=20):
+    profiler.dump_stats(file_path)
+    pstats.Stats(file_path).sort_stats("cumulative").print_stats(limit)
+    print "Profile written to", file_path
+
+
+def add_cache_arguments(parser):
+    parser.add_argument("-c", "--cache", help="The response cache, either a pack file or a legacy cache directory", default=cache.DEFAULT_PACK_PATH)
+    parser.add_argument("--import-cache", help="A legacy cache directory to import into the pack file before running", default=None)
+
+
+def check_cache_arguments(parser, args):
+    # Only a pack file can be imported into, a cache directory is opened as is.
+    if args.import_cache is not None and os.path.isdir(args.cache):
+        parser.error("--import-cache needs --cache to be a pack file, not a cache directory")
+
+
+def open_response_cache(args):
+    response_cache = cache.open_cache(args.cache)
+    if args.import_cache is not None:
+        print "Imported", response_cache.import_directory(args.import_cache), "cached responses from", args.import_cache
+    crestscrape.set_response_cache(response_cache)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=DESCRIPTION)
     parser.add_argument("target_url", help="The url that points to the tournament match endpoint")
     parser.add_argument("save_folder", help="A directory in which to save the generated scene data", default=".", nargs="?")
-    parser.add_argument("-f", "--follow", help="The item-id of a ship that the camera should follow ", default=None, nargs="?")
+    add_follow_arguments(parser)
+    parser.add_argument("-p", "--pipeline", help="Fetch replay frames in the background while parsing", action="store_true")
+    parser.add_argument("-w", "--workers", help="Number of threads used to fetch static resources, while setting up the scene and in pipeline mode", default=crestscrape.RESOURCE_WORKERS, type=int)
+    add_window_arguments(parser)
+    parser.add_argument("--archive", help="Generate the scene from this archive of the parsed match, parsing the match and creating the archive if it does not exist yet", default=None)
+    add_curve_arguments(parser)
+    add_scene_arguments(parser)
+    add_drone_budget_arguments(parser)
+    add_client_arguments(parser)
+    add_checkpoint_arguments(parser)
+    add_cache_arguments(parser)
+    add_report_arguments(parser)
     args = parser.parse_args()
-    main(args.target_url, args.save_folder, args.follow)
+    if args.start is not None and args.end is not None and args.end <= args.start:
+        parser.error("--end has to be after --start")
+    if args.drone_budget is not None and args.drone_budget < 0:
+        parser.error("--drone-budget can not be negative")
+    check_cache_arguments(parser, args)
+    open_response_cache(args)
+    create_crest_client(args)
+    profiler = None
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with metrics.stage("total"):
+            main(args.target_url, args.save_folder, args.follow, args.pipeline, args.workers, get_curve_options(args),
+                 checkpoint_folder=args.checkpoint_folder, checkpoint_interval=args.checkpoint_interval,
+                 command_quantum=get_command_quantum(args), start=args.start, end=args.end, archive_path=args.archive,
+                 drone_budget=get_drone_budget(args))
+    except crestclient.CrestError as e:
+        print e
+        sys.exit(1)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            print_profile(profiler, args.profile)
+        if args.report is not None:
+            write_report(args.report)
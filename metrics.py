@@ -0,0 +1,89 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+
+class Metrics(object):
+    """
+    Wall time per stage and counters, shared by all the threads of a
+    conversion. Stages can run inside each other and on several threads at
+    once, in which case their times overlap.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
+            self.counters.clear()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_time(self, name, duration):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + duration
+
+    def stage(self, name):
+        return StageTimer(self, name)
+
+    def report(self):
+        with self.lock:
+            return OrderedDict((
+                ("stages", OrderedDict(self.stages)),
+                ("counters", OrderedDict(self.counters)),
+                ("peak_memory_bytes", get_peak_memory()),
+            ))
+
+
+class StageTimer(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_time(self.name, time.time() - self.start)
+
+
+def get_peak_memory():
+    """
+    The peak resident memory of this process in bytes, or None where it can
+    not be found out.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            return peak
+        return peak * 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memory_info = psutil.Process().memory_info()
+    return getattr(memory_info, "peak_wset", memory_info.rss)
+
+
+metrics = Metrics()
+
+
+def count(name, amount=1):
+    metrics.count(name, amount)
+
+
+def stage(name):
+    return metrics.stage(name)
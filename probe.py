@@ -1,5 +1,183 @@
+import itertools
+import re
+from collections import OrderedDict
+from cStringIO import StringIO
+
 import yaml
 
+import metrics
+
+try:
+    from yaml import CDumper as Dumper
+except ImportError:
+    from yaml import Dumper
+
+# How many commands are dumped at a time when saving.
+COMMAND_CHUNK_SIZE = 1000
+PRINTABLE_ASCII = re.compile(r"^[\x20-\x7e]*$")
+ITEM_START = re.compile(r"^- ", re.M)
+# Sleeps shorter than this are merged by optimize_commands, in seconds.
+DEFAULT_TIME_QUANTUM = 0.05
+
+
+def is_plain_scalar(node):
+    # Other than the quotes asked for by SceneDumper, the representer only
+    # gives a style to multi-line and binary strings.
+    return isinstance(node, yaml.ScalarNode) and node.style in (None, "'")
+
+
+class SceneDumper(Dumper):
+    """
+    Dumps the same yaml as yaml.dump does with the pure python dumper. libyaml
+    writes unicode strings tagged with !!python/unicode without quotes, where
+    the python emitter always quotes them, so they ask for quotes explicitly.
+    Collections of scalars still use the flow style.
+    """
+    def represent_unicode(self, data):
+        node = Dumper.represent_unicode(self, data)
+        if node.tag == u"tag:yaml.org,2002:python/unicode":
+            node.style = "'"
+        return node
+
+    def represent_sequence(self, tag, sequence, flow_style=None):
+        node = Dumper.represent_sequence(self, tag, sequence, flow_style)
+        if flow_style is None and self.default_flow_style is None:
+            node.flow_style = all(is_plain_scalar(item) for item in node.value)
+        return node
+
+    def represent_mapping(self, tag, mapping, flow_style=None):
+        node = Dumper.represent_mapping(self, tag, mapping, flow_style)
+        if flow_style is None and self.default_flow_style is None:
+            node.flow_style = all(is_plain_scalar(key) and is_plain_scalar(value) for key, value in node.value)
+        return node
+
+SceneDumper.add_representer(unicode, SceneDumper.represent_unicode)
+
+
+def is_printable_ascii(value):
+    if isinstance(value, basestring):
+        return PRINTABLE_ASCII.match(value) is not None
+    if isinstance(value, (list, tuple)):
+        return all(is_printable_ascii(item) for item in value)
+    return True
+
+
+def get_dumper(commands):
+    """
+    libyaml escapes and wraps strings with characters outside printable ASCII
+    differently from the python emitter, so commands holding any are left to
+    the python dumper.
+    """
+    if all(is_printable_ascii(command) for command in commands):
+        return SceneDumper
+    return yaml.Dumper
+
+
+
+def dump_commands(commands, f):
+    """
+    Writes the commands as the items of a block sequence, a chunk at a time.
+    """
+    for i in xrange(0, len(commands), COMMAND_CHUNK_SIZE):
+        chunk = commands[i:i + COMMAND_CHUNK_SIZE]
+        yaml.dump(chunk, f, Dumper=get_dumper(chunk))
+
+
+class RenderCache(object):
+    """
+    The yaml of commands that have already been written, so that scene files
+    sharing most of their commands, like the cameras of a match, only dump
+    each of them once. Commands are looked up by the repr of their items.
+    When a block sequence is dumped each item starts a line with "- " and
+    everything else is indented, which is how the yaml of a chunk is split
+    into the yaml of each command.
+    """
+    def __init__(self):
+        self.texts = {}
+
+    def render(self, commands):
+        f = StringIO()
+        dump_commands(commands, f)
+        text = f.getvalue()
+        starts = [match.start() for match in ITEM_START.finditer(text)]
+        if len(starts) != len(commands):
+            return [self.render([command])[0] for command in commands]
+        return [text[start:end] for start, end in zip(starts, starts[1:] + [len(text)])]
+
+    def write(self, commands, f):
+        for i in xrange(0, len(commands), COMMAND_CHUNK_SIZE):
+            keys = [tuple(map(repr, command)) for command in commands[i:i + COMMAND_CHUNK_SIZE]]
+            missing = OrderedDict()
+            for key, command in itertools.izip(keys, commands[i:i + COMMAND_CHUNK_SIZE]):
+                if key not in self.texts:
+                    missing[key] = command
+            if missing:
+                self.texts.update(itertools.izip(missing.keys(), self.render(missing.values())))
+            f.write("".join([self.texts[key] for key in keys]))
+
+
+def optimize_commands(commands, time_quantum=DEFAULT_TIME_QUANTUM):
+    """
+    Returns a shorter list of commands that plays back the same scene, and an
+    OrderedDict of how many commands of each kind were removed:
+     - sleeps are held back until they add up to at least time_quantum, so
+       events less than that apart happen together and the total time of the
+       scene is unchanged,
+     - clear_behaviors commands, and the add_behavior commands right after
+       them, that give a camera the behaviors it already has are dropped,
+     - fire commands are coalesced, a turret firing at the same target with
+       the same ammo again within one sleep fires once.
+    """
+    optimized = []
+    removed = OrderedDict((("sleep", 0), ("camera", 0), ("fire", 0)))
+    pending_sleep = 0.0
+    behaviors = {}
+    fired = set()
+    i = 0
+    while i < len(commands):
+        command = commands[i]
+        name = command[0]
+        if name == "sleep":
+            pending_sleep += command[1]
+            i += 1
+            continue
+        if pending_sleep > 0 and pending_sleep >= time_quantum:
+            optimized.append(["sleep", pending_sleep])
+            pending_sleep = 0.0
+            fired.clear()
+
+        if name == "clear_behaviors":
+            camera = command[1]
+            end = i + 1
+            while end < len(commands) and commands[end][0] == "add_behavior" and commands[end][1] == camera:
+                end += 1
+            new_behaviors = [behavior[2:] for behavior in commands[i + 1:end]]
+            if new_behaviors == behaviors.get(camera):
+                removed["camera"] += end - i
+            else:
+                optimized.extend(commands[i:end])
+                behaviors[camera] = new_behaviors
+            i = end
+            continue
+        if name == "add_behavior":
+            behaviors.setdefault(command[1], []).append(command[2:])
+        elif name == "fire":
+            source, slot, target, _, ammo = command[1:]
+            if (source, slot, target, ammo) in fired:
+                removed["fire"] += 1
+                i += 1
+                continue
+            fired.add((source, slot, target, ammo))
+        optimized.append(command)
+        i += 1
+    if pending_sleep:
+        optimized.append(["sleep", pending_sleep])
+
+    sleep_count = sum(1 for command in commands if command[0] == "sleep")
+    removed["sleep"] = sleep_count - sum(1 for command in optimized if command[0] == "sleep")
+    return optimized, removed
+
+
 class SceneFile(object):
     def __init__(self, ship_to_follow):
         self.ship_to_follow = ship_to_follow
@@ -8,6 +186,9 @@ class SceneFile(object):
             "description": "Autogenerated scene file",
             "commands": []
         }
+        # Timed events are added relative to this, so that later events can
+        # be appended with another call to add_timed_events.
+        self.last_event_time = 0
 
     def display(self):
         print yaml.dump(self.data, default_flow_style=False)
@@ -42,17 +223,54 @@ class SceneFile(object):
             self.add_command(["clear_behaviors", "main"])
             self.add_command(["add_behavior", "main", "Follow", self.ship_to_follow, 300])
 
-    def add_timed_events(self, timed_events):
-        event_times = sorted(timed_events.keys())
-        last_time = 0.0
-        for time in event_times:
-            if time > last_time:
+    def add_timed_events(self, timed_events, units_per_second=1.0):
+        """
+        Adds (time, events) pairs sorted by time, with the times in
+        units_per_second. Several pairs can have the same time.
+        """
+        for time, events in timed_events:
+            if time > self.last_event_time:
                 self.update_camera()
-                self.add_sleep(time - last_time)
-                last_time = time
-            for event in timed_events[time]:
+                self.add_sleep((time - self.last_event_time) / float(units_per_second))
+                self.last_event_time = time
+            for event in events:
                 self.add_command(event)
 
-    def save(self, file_path):
-        with open(file_path, "w") as f:
-            f.write(yaml.dump(self.data))
+    def optimize(self, time_quantum=DEFAULT_TIME_QUANTUM):
+        """
+        Runs optimize_commands over the commands of the scene.
+        Returns how many commands of each kind were removed.
+        """
+        with metrics.stage("optimize"):
+            self.data["commands"], removed = optimize_commands(self.data["commands"], time_quantum)
+        metrics.count("commands_removed", sum(removed.values()))
+        return removed
+
+    def save(self, file_path, render_cache=None):
+        metrics.count("commands", len(self.data["commands"]))
+        with metrics.stage("yaml_dump"):
+            with open(file_path, "w") as f:
+                self.write(f, render_cache)
+
+    def write(self, f, render_cache=None):
+        """
+        Writes the same yaml as yaml.dump(self.data), but streams the commands
+        to f a chunk at a time instead of building the whole document in
+        memory. The items of a block sequence come out the same whether they
+        are dumped together or not, as long as no two commands share a list,
+        which would make yaml.dump use an anchor. That also lets a RenderCache
+        write the commands it has seen before.
+        """
+        for key in sorted(self.data):
+            value = self.data[key]
+            if key == "commands" and value:
+                f.write("commands:\n")
+                if render_cache is not None:
+                    render_cache.write(value, f)
+                else:
+                    dump_commands(value, f)
+            else:
+                # As part of the whole document a mapping holding a scalar is
+                # written in block style, on its own it would be a flow one.
+                flow_style = None if isinstance(value, (list, dict)) else False
+                yaml.dump({key: value}, f, Dumper=get_dumper([value]), default_flow_style=flow_style)
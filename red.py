@@ -1,25 +1,47 @@
+from cStringIO import StringIO
+
+import numpy
+
 import geometry
+import metrics
 import templates
 
+WRITE_BUFFER_SIZE = 1 << 20
+INTERPOLATION_LINEAR = 1
+INTERPOLATION_HERMITE = 2
+
+
+def to_string(red_object):
+    buffer = StringIO()
+    red_object.write(buffer)
+    return buffer.getvalue()
+
 
 class EveSpaceScene():
     def __init__(self):
         self.curve_sets = []
-    def __str__(self):
-        s = templates.eve_space_scene
+
+    def write_header(self, f):
+        f.write(templates.eve_space_scene)
+
+    def write(self, f):
+        self.write_header(f)
         if self.curve_sets:
-            s += "\ncurveSets:"
+            f.write("\ncurveSets:")
         for i in self.curve_sets:
-            s += str(i)
-        return s
+            i.write(f)
+
+    def __str__(self):
+        return to_string(self)
 
 
 class Tr2ScalarKey(object):
-    def __init__(self, time, value, left_tangent, right_tangent):
+    def __init__(self, time, value, left_tangent, right_tangent, interpolation=INTERPOLATION_LINEAR):
         self.time = time
         self.value = value
         self.left_tangent = left_tangent
         self.right_tangent = right_tangent
+        self.interpolation = interpolation
 
     def __str__(self):
         return templates.scalar_key.format(
@@ -27,11 +49,16 @@ class Tr2ScalarKey(object):
             value=self.value,
             left_tangent=self.left_tangent,
             right_tangent=self.right_tangent,
+            interpolation=self.interpolation,
             )
 
+    def write(self, f):
+        f.write(self.__str__())
+
 
 class Tr2ScalarCurve(object):
-    def __init__(self, curve_type, time_offset, length, start_value, end_value, start_tangent, end_tangent):
+    def __init__(self, curve_type, time_offset, length, start_value, end_value, start_tangent, end_tangent,
+                 interpolation=INTERPOLATION_LINEAR):
         self.curve_type = curve_type
         self.time_offset = time_offset
         self.length = length
@@ -39,10 +66,11 @@ class Tr2ScalarCurve(object):
         self.end_value = end_value
         self.start_tangent = start_tangent
         self.end_tangent = end_tangent
+        self.interpolation = interpolation
         self.scalar_keys = []
 
-    def __str__(self):
-        s = templates.rotation_curve_header.format(
+    def write(self, f):
+        f.write(templates.rotation_curve_header.format(
             curve_type=self.curve_type,
             length=self.length,
             start_value=self.start_value,
@@ -50,14 +78,15 @@ class Tr2ScalarCurve(object):
             start_tangent=self.start_tangent,
             end_tangent=self.end_tangent,
             time_offset=self.time_offset,
-            )
+            interpolation=self.interpolation,
+            ))
         if self.scalar_keys:
-            s += "\n            keys:"
+            f.write("\n            keys:")
         for i in self.scalar_keys:
-            s += str(i)
-
-        return s
+            i.write(f)
 
+    def __str__(self):
+        return to_string(self)
 
 
 class Tr2EulerRotation(object):
@@ -67,26 +96,41 @@ class Tr2EulerRotation(object):
         self.pitch = pitch
         self.roll = roll
 
-    def __str__(self):
-        s = templates.euler_rotation_header.format(
+    def write(self, f):
+        f.write(templates.euler_rotation_header.format(
             object_name=self.object_name
-        )
+        ))
         if self.yaw is not None:
-            s += self.yaw.__str__()
+            self.yaw.write(f)
         if self.pitch is not None:
-            s += self.pitch.__str__()
+            self.pitch.write(f)
         if self.roll is not None:
-            s += self.roll.__str__()
-        return s
+            self.roll.write(f)
+
+    def __str__(self):
+        return to_string(self)
+
+
+class FormattedKeys(object):
+    """
+    A run of keys that have already been formatted, so that they can be
+    written again without formatting every key each time.
+    """
+    def __init__(self, keys):
+        self.text = "".join(str(key) for key in keys)
+
+    def write(self, f):
+        f.write(self.text)
 
 
 class Tr2VectorKey(object):
-    def __init__(self, object_name, value, right_tangent, left_tangent, time):
+    def __init__(self, object_name, value, right_tangent, left_tangent, time, interpolation=INTERPOLATION_LINEAR):
         self.object_name = object_name
         self.value = value
         self.right_tangent = right_tangent
         self.left_tangent = left_tangent
         self.time = time
+        self.interpolation = interpolation
 
 
     def __str__(self):
@@ -95,12 +139,17 @@ class Tr2VectorKey(object):
             value=self.value,
             right_tangent=self.right_tangent,
             left_tangent=self.left_tangent,
-            time=self.time
+            time=self.time,
+            interpolation=self.interpolation,
             )
 
+    def write(self, f):
+        f.write(self.__str__())
+
 
 class Tr2VectorCurve(object):
-    def __init__(self, object_name, time_offset, length, start_value, end_value, start_tangent, end_tangent):
+    def __init__(self, object_name, time_offset, length, start_value, end_value, start_tangent, end_tangent,
+                 interpolation=INTERPOLATION_LINEAR):
         self.object_name = object_name
         self.time_offset = time_offset
         self.length = length
@@ -108,10 +157,11 @@ class Tr2VectorCurve(object):
         self.end_value = end_value
         self.start_tangent = start_tangent
         self.end_tangent = end_tangent
+        self.interpolation = interpolation
         self.keys = []
 
-    def __str__(self):
-        s = templates.location_curve_header.format(
+    def write(self, f):
+        f.write(templates.location_curve_header.format(
             object_name=self.object_name,
             time_offset=self.time_offset,
             length=self.length,
@@ -119,12 +169,15 @@ class Tr2VectorCurve(object):
             end_value=self.end_value,
             start_tangent=self.start_tangent,
             end_tangent=self.end_tangent,
-        )
+            interpolation=self.interpolation,
+        ))
         if self.keys:
-            s += "\n        keys:"
+            f.write("\n        keys:")
             for i in self.keys:
-                s += str(i)
-        return s
+                i.write(f)
+
+    def __str__(self):
+        return to_string(self)
 
 
 class TriCurveSet(object):
@@ -132,11 +185,13 @@ class TriCurveSet(object):
         self.object_name = object_name
         self.curves = []
 
-    def __str__(self):
-        s = templates.curve_set_header.format(object_name=self.object_name)
+    def write(self, f):
+        f.write(templates.curve_set_header.format(object_name=self.object_name))
         for c in self.curves:
-            s += c.__str__()
-        return s
+            c.write(f)
+
+    def __str__(self):
+        return to_string(self)
 
     def __repr__(self):
         return """TriCurveSet
@@ -151,57 +206,114 @@ class TriCurveSet(object):
 
 
 class RedFile(object):
-    def __init__(self):
+    """
+    Collects the curves for each actor. When opened with a file path, every
+    curve set is written out by finish_curve_set as soon as its keys are
+    complete, so only the curves of the actor being generated are kept in
+    memory. Otherwise everything is written by save.
+    """
+    def __init__(self, file_path=None):
         self.scene = EveSpaceScene()
         self.curve_sets = {}
-
-    def add_vector_curve(self, id, time_offset, length, start_value, end_value):
-        start_tangent = [0.0, 0.0, 0.0]
-        end_tangent = [0.0, 0.0, 0.0]
+        self.stream = None
+        self.curve_sets_written = 0
+        if file_path is not None:
+            self.open(file_path)
+
+    def open(self, file_path):
+        self.stream = open(file_path, "w", WRITE_BUFFER_SIZE)
+        self.scene.write_header(self.stream)
+
+    def finish_curve_set(self, id):
+        """
+        Called once all the keys of an actor have been added. When streaming,
+        its curve set is written out and released.
+        """
+        metrics.count("curve_sets")
+        if self.stream is None:
+            return
+        curve_set = self.curve_sets.pop(id)
+        self.scene.curve_sets.remove(curve_set)
+        with metrics.stage("red_write"):
+            if self.curve_sets_written == 0:
+                self.stream.write("\ncurveSets:")
+            curve_set.write(self.stream)
+        self.curve_sets_written += 1
+
+    def close(self):
+        for curve_set in list(self.scene.curve_sets):
+            self.finish_curve_set(curve_set.object_name)
+        self.stream.close()
+        self.stream = None
+
+    def get_curve_set(self, id):
         if id not in self.curve_sets:
             curve_set = TriCurveSet(id)
             self.curve_sets[id] = curve_set
-        else:
-            curve_set = self.curve_sets[id]
-        curve_set.curves.append(Tr2VectorCurve(id, time_offset, length, start_value, end_value, start_tangent, end_tangent))
-        self.scene.curve_sets.append(curve_set)
+            self.scene.curve_sets.append(curve_set)
+        return self.curve_sets[id]
+
+    def add_vector_curve(self, id, time_offset, length, start_value, end_value, start_tangent=None, end_tangent=None,
+                         interpolation=INTERPOLATION_LINEAR):
+        if start_tangent is None:
+            start_tangent = [0.0, 0.0, 0.0]
+        if end_tangent is None:
+            end_tangent = [0.0, 0.0, 0.0]
+        curve_set = self.get_curve_set(id)
+        curve_set.curves.append(Tr2VectorCurve(
+            id, time_offset, length, start_value, end_value, start_tangent, end_tangent, interpolation
+        ))
+
+    def get_vector_curve(self, id):
+        for curve in self.curve_sets[id].curves:
+            if isinstance(curve, Tr2VectorCurve):
+                return curve
+        return None
 
     def add_vector_key(self, id, value, time):
-        curve_set = self.curve_sets[id]
-        vector_curve = None
-        for curve in curve_set.curves:
-            if isinstance(curve, Tr2VectorCurve):
-                vector_curve = curve
-                break
+        vector_curve = self.get_vector_curve(id)
         left_tangent = [0, 0, 0]
         right_tangent = [0, 0, 0]
         key = Tr2VectorKey(id, value, right_tangent, left_tangent, time)
         vector_curve.keys.append(key)
-
-    def add_rotation_curve(self, id, time_offset, length, start_value, end_value):
-        if id not in self.curve_sets:
-            curve_set = TriCurveSet(id)
-            self.curve_sets[id] = curve_set
-        else:
-            curve_set = self.curve_sets[id]
+        metrics.count("vector_keys")
+
+    def add_vector_keys(self, id, values, times, tangents=None):
+        """
+        Adds a key for each value. When an (n, 3) array of tangents is given,
+        usually the velocities, the keys use hermite interpolation.
+        """
+        vector_curve = self.get_vector_curve(id)
+        metrics.count("vector_keys", len(values))
+        if tangents is None:
+            left_tangent = [0, 0, 0]
+            right_tangent = [0, 0, 0]
+            for value, time in zip(values, times):
+                vector_curve.keys.append(Tr2VectorKey(id, value, right_tangent, left_tangent, time))
+            return
+        for value, time, tangent in zip(values, times, numpy.asarray(tangents).tolist()):
+            vector_curve.keys.append(Tr2VectorKey(id, value, tangent, tangent, time, INTERPOLATION_HERMITE))
+
+    def add_rotation_curve(self, id, time_offset, length, start_value, end_value, interpolation=INTERPOLATION_LINEAR):
+        curve_set = self.get_curve_set(id)
 
         start_yaw, start_pitch, start_roll = start_value.to_yaw_pitch_roll()
         end_yaw, end_pitch, end_roll = end_value.to_yaw_pitch_roll()
 
-        yaw_curve =   Tr2ScalarCurve("yawCurve",   time_offset, length, start_yaw, end_yaw, 0.0, 0.0)
-        pitch_curve = Tr2ScalarCurve("pitchCurve", time_offset, length, start_pitch, end_pitch, 0.0, 0.0)
-        roll_curve =  Tr2ScalarCurve("rollCurve",  time_offset, length, start_roll, end_roll, 0.0, 0.0)
+        yaw_curve =   Tr2ScalarCurve("yawCurve",   time_offset, length, start_yaw, end_yaw, 0.0, 0.0, interpolation)
+        pitch_curve = Tr2ScalarCurve("pitchCurve", time_offset, length, start_pitch, end_pitch, 0.0, 0.0, interpolation)
+        roll_curve =  Tr2ScalarCurve("rollCurve",  time_offset, length, start_roll, end_roll, 0.0, 0.0, interpolation)
 
         curve_set.curves.append(Tr2EulerRotation(id, yaw_curve, pitch_curve, roll_curve))
-        self.scene.curve_sets.append(curve_set)
 
-    def add_rotation_key(self, id, value, time):
-        curve_set = self.curve_sets[id]
-        euler_curve = None
-        for curve in curve_set.curves:
+    def get_euler_rotation(self, id):
+        for curve in self.curve_sets[id].curves:
             if isinstance(curve, Tr2EulerRotation):
-                euler_curve = curve
-                break
+                return curve
+        return None
+
+    def add_rotation_key(self, id, value, time):
+        euler_curve = self.get_euler_rotation(id)
         left_tangent = 0.0
         right_tangent = 0.0
 
@@ -213,10 +325,53 @@ class RedFile(object):
         euler_curve.yaw.scalar_keys.append(yaw_key)
         euler_curve.pitch.scalar_keys.append(pitch_key)
         euler_curve.roll.scalar_keys.append(roll_key)
+        metrics.count("rotation_keys")
+
+    def add_rotation_keys(self, id, values, times, hermite=False):
+        """
+        Adds a rotation key for each row of the (n, 3) array of directions in
+        values, computing all the angles in one go.
+        With hermite set, the yaw is unwrapped so that it does not spin around
+        at +-pi, and each key gets the rate of change of its angle as tangent.
+        """
+        euler_curve = self.get_euler_rotation(id)
+
+        yaw_values, pitch_values, roll_values = geometry.vectors_to_yaw_pitch_roll(values)
+        metrics.count("rotation_keys", len(yaw_values))
+        if not hermite:
+            times = list(times)
+            left_tangent = 0.0
+            right_tangent = 0.0
+            euler_curve.yaw.scalar_keys.extend(
+                Tr2ScalarKey(time, value, right_tangent, left_tangent) for time, value in zip(times, yaw_values.tolist())
+            )
+            euler_curve.pitch.scalar_keys.extend(
+                Tr2ScalarKey(time, value, right_tangent, left_tangent) for time, value in zip(times, pitch_values.tolist())
+            )
+            euler_curve.roll.scalar_keys.extend(
+                Tr2ScalarKey(time, value, right_tangent, left_tangent) for time, value in zip(times, roll_values.tolist())
+            )
+            return
+
+        times = numpy.asarray(times, dtype=numpy.float64)
+        yaw_values = numpy.unwrap(yaw_values)
+        if len(yaw_values):
+            # The curve has to end where its unwrapped keys do.
+            euler_curve.yaw.end_value = float(yaw_values[-1])
+        for curve, angles in ((euler_curve.yaw, yaw_values), (euler_curve.pitch, pitch_values), (euler_curve.roll, roll_values)):
+            if len(times) > 1:
+                tangents = numpy.gradient(angles.astype(numpy.float64), times)
+            else:
+                tangents = numpy.zeros(len(times))
+            curve.scalar_keys.extend(
+                Tr2ScalarKey(time, value, tangent, tangent, INTERPOLATION_HERMITE)
+                for time, value, tangent in zip(times.tolist(), angles.tolist(), tangents.tolist())
+            )
 
     def save(self, file_path):
-        with open(file_path, "w") as f:
-            f.write(self.scene.__str__())
+        with metrics.stage("red_write"):
+            with open(file_path, "w", WRITE_BUFFER_SIZE) as f:
+                self.scene.write(f)
 
     def display(self):
         print self.scene
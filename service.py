@@ -0,0 +1,353 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import traceback
+import urllib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import batch
+import main
+
+DESCRIPTION = "Runs a local HTTP service that converts matches for everyone \
+pointing at it. Jobs are converted on a pool of processes sharing one response \
+cache, and the scene files are kept and served again for any later job with the \
+same match and options."
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_RESULTS_FOLDER = "results"
+DEFAULT_PROCESSES = batch.DEFAULT_PROCESSES
+ARCHIVE_FOLDER = "archives"
+JOB_FILE_NAME = "job.json"
+LOG_FILE_NAME = "log.txt"
+RESULT_FOLDERS = ("sequences", "curves")
+CONTENT_TYPES = {".yaml": "text/yaml", ".red": "application/octet-stream"}
+JOB_ID = re.compile(r"^[0-9a-f]{40}$")
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobError(Exception):
+    pass
+
+
+class JobArgumentParser(argparse.ArgumentParser):
+    # Bad job options are reported to the client instead of exiting.
+    def error(self, message):
+        raise JobError(message)
+
+
+def create_job_parser():
+    """
+    The options a job can have are the command line options of main.py that
+    shape the scene files.
+    """
+    parser = JobArgumentParser(prog="job", add_help=False)
+    main.add_follow_arguments(parser)
+    main.add_window_arguments(parser)
+    main.add_curve_arguments(parser)
+    main.add_scene_arguments(parser)
+    main.add_drone_budget_arguments(parser)
+    return parser
+
+
+def get_key(*values):
+    return hashlib.sha1(json.dumps(values, sort_keys=True)).hexdigest()
+
+
+class Job(object):
+    """
+    A conversion of a match with a set of options. Its id is derived from the
+    match url and the parsed options, so that the same conversion requested
+    twice, however its options were written, is the same job.
+    """
+    def __init__(self, target_url, job_args, parser):
+        self.target_url = target_url
+        self.job_args = job_args
+        args = parser.parse_args(job_args)
+        if args.start is not None and args.end is not None and args.end <= args.start:
+            raise JobError("--end has to be after --start")
+        if args.drone_budget is not None and args.drone_budget < 0:
+            raise JobError("--drone-budget can not be negative")
+        self.args = args
+        self.id = get_key(target_url, vars(args))
+        # Jobs of the same match and window share the parsed replay.
+        self.match_key = get_key(target_url, args.start, args.end)
+        self.status = QUEUED
+        self.error = None
+        self.submitted = time.time()
+        self.duration = None
+
+    def get_task(self, save_folder, archive_path):
+        args = self.args
+        return (self.target_url, save_folder, args.follow, main.get_curve_options(args), main.get_command_quantum(args),
+                args.start, args.end, main.get_drone_budget(args), archive_path)
+
+    def to_json(self):
+        return {"target_url": self.target_url, "args": self.job_args}
+
+
+def convert_job(task):
+    """
+    Runs main.main in a worker process, with its output going to a log file
+    next to the scene files.
+    """
+    target_url, save_folder, ships_to_follow, curve_options, command_quantum, start, end, drone_budget, archive_path = task
+    started = time.time()
+    stdout = sys.stdout
+    sys.stdout = open(os.path.join(save_folder, LOG_FILE_NAME), "w")
+    try:
+        scene_name = main.main(target_url, save_folder, ships_to_follow, curve_options=curve_options,
+                               command_quantum=command_quantum, start=start, end=end, archive_path=archive_path,
+                               drone_budget=drone_budget)
+    except Exception:
+        return batch.MatchResult(target_url, error=traceback.format_exc(), duration=time.time() - started)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return batch.MatchResult(target_url, scene_name=scene_name, duration=time.time() - started)
+
+
+class ConversionService(object):
+    """
+    Queues the jobs and runs them on a pool of processes. A job that is
+    already queued, running or done is not run again, and only one job per
+    match runs at a time, so that the jobs after it regenerate the scene from
+    the replay it parsed and archived instead of parsing it again.
+    The scene files of every finished job are kept in a folder named after
+    its id, which is only created once the job has succeeded.
+    """
+    def __init__(self, results_folder, args, processes=DEFAULT_PROCESSES):
+        self.results_folder = results_folder
+        self.archive_folder = os.path.join(results_folder, ARCHIVE_FOLDER)
+        main.make_folder(self.archive_folder)
+        self.parser = create_job_parser()
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.busy_matches = set()
+        # Jobs waiting for a job of the same match to finish, by match key.
+        self.waiting = {}
+        self.pool = multiprocessing.Pool(processes, batch.initialize_worker, (args,))
+
+    def get_result_folder(self, job_id):
+        return os.path.join(self.results_folder, job_id)
+
+    def submit(self, target_url, job_args):
+        """
+        Returns the job converting target_url with the given main.py options,
+        queueing it unless it is already known or its results are on disk.
+        """
+        job = Job(target_url, job_args, self.parser)
+        with self.lock:
+            known = self.jobs.get(job.id) or self.load_finished_job(job.id)
+            if known is not None and known.status != FAILED:
+                return known
+            self.jobs[job.id] = job
+            if job.match_key in self.busy_matches:
+                self.waiting.setdefault(job.match_key, []).append(job)
+            else:
+                self.start(job)
+        return job
+
+    def load_finished_job(self, job_id):
+        job_file_path = os.path.join(self.get_result_folder(job_id), JOB_FILE_NAME)
+        if not os.path.exists(job_file_path):
+            return None
+        with open(job_file_path) as f:
+            job_json = json.load(f)
+        job = Job(job_json["target_url"], job_json["args"], self.parser)
+        job.status = DONE
+        self.jobs[job.id] = job
+        return job
+
+    def get_job(self, job_id):
+        if not JOB_ID.match(job_id):
+            return None
+        with self.lock:
+            return self.jobs.get(job_id) or self.load_finished_job(job_id)
+
+    def start(self, job):
+        # Called with the lock held.
+        self.busy_matches.add(job.match_key)
+        save_folder = self.get_result_folder(job.id) + ".tmp"
+        shutil.rmtree(save_folder, ignore_errors=True)
+        main.make_folder(save_folder)
+        with open(os.path.join(save_folder, JOB_FILE_NAME), "w") as f:
+            json.dump(job.to_json(), f)
+        archive_path = os.path.join(self.archive_folder, job.match_key + ".npz")
+        job.status = RUNNING
+        print "Converting", job.target_url, " ".join(job.job_args), "as", job.id
+        self.pool.apply_async(convert_job, (job.get_task(save_folder, archive_path),),
+                              callback=lambda result: self.finish(job, save_folder, result))
+
+    def finish(self, job, save_folder, result):
+        with self.lock:
+            job.duration = result.duration
+            if result.succeeded():
+                os.rename(save_folder, self.get_result_folder(job.id))
+                job.status = DONE
+                print "Finished", job.id, "in %.1fs" % result.duration
+            else:
+                job.status = FAILED
+                job.error = result.error
+                print "Failed", job.id
+                print result.error
+            waiting = self.waiting.get(job.match_key)
+            if waiting:
+                self.start(waiting.pop(0))
+            else:
+                self.waiting.pop(job.match_key, None)
+                self.busy_matches.discard(job.match_key)
+
+    def get_files(self, job):
+        """
+        Returns the paths of the scene files of a finished job, relative to
+        its result folder.
+        """
+        files = []
+        for folder in RESULT_FOLDERS:
+            folder_path = os.path.join(self.get_result_folder(job.id), folder)
+            for file_name in sorted(os.listdir(folder_path)):
+                files.append(folder + "/" + file_name)
+        return files
+
+    def get_file_path(self, job, relative_path):
+        """
+        Returns where a scene file of a finished job is, or None if it has no
+        such file.
+        """
+        if job.status != DONE:
+            return None
+        if relative_path.count("/") != 1:
+            return None
+        folder, file_name = relative_path.split("/")
+        if folder not in RESULT_FOLDERS or file_name in ("", ".", ".."):
+            return None
+        file_path = os.path.join(self.get_result_folder(job.id), folder, file_name)
+        if not os.path.isfile(file_path):
+            return None
+        return file_path
+
+    def describe(self, job):
+        description = {
+            "id": job.id,
+            "target_url": job.target_url,
+            "args": job.job_args,
+            "status": job.status,
+        }
+        if job.duration is not None:
+            description["duration"] = job.duration
+        if job.status == DONE:
+            description["files"] = ["/jobs/{id}/{path}".format(id=job.id, path=urllib.quote(path)) for path in self.get_files(job)]
+        if job.status == FAILED:
+            description["error"] = job.error
+        return description
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def create_handler(service):
+    """
+    Jobs are submitted with a POST to /jobs of a json object holding the
+    target_url and, optionally, args, a list of main.py options such as
+    ["-f", "1000001", "--smooth"]. The reply describes the job, whose status
+    can be polled at /jobs/<id>. Once it is done, it lists the urls of the
+    scene files.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.rstrip("/") != "/jobs":
+                return self.send_json(404, {"error": "Not found"})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.getheader("Content-Length", 0))))
+                target_url = request["target_url"]
+                if not isinstance(target_url, basestring):
+                    raise JobError("target_url has to be a string")
+                job_args = [str(arg) for arg in request.get("args", [])]
+                job = service.submit(target_url, job_args)
+            except (ValueError, KeyError, TypeError, JobError) as e:
+                return self.send_json(400, {"error": "Bad job: %s" % e})
+            self.send_json(202 if job.status in (QUEUED, RUNNING) else 200, service.describe(job))
+
+        def do_GET(self):
+            parts = urllib.unquote(self.path.split("?")[0]).strip("/").split("/", 2)
+            if len(parts) < 2 or parts[0] != "jobs":
+                return self.send_json(404, {"error": "Not found"})
+            job = service.get_job(parts[1])
+            if job is None:
+                return self.send_json(404, {"error": "No such job"})
+            if len(parts) == 2:
+                return self.send_json(200, service.describe(job))
+            file_path = service.get_file_path(job, parts[2])
+            if file_path is None:
+                return self.send_json(404, {"error": "No such file"})
+            self.send_file(file_path)
+
+        def send_json(self, status, data):
+            body = json.dumps(data, indent=2)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_file(self, file_path):
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPES.get(os.path.splitext(file_path)[1], "application/octet-stream"))
+            self.send_header("Content-Length", str(os.path.getsize(file_path)))
+            self.end_headers()
+            with open(file_path, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("--host", help="The address to listen on, use 0.0.0.0 to serve other machines", default=DEFAULT_HOST)
+    parser.add_argument("-p", "--port", help="The port to listen on", default=DEFAULT_PORT, type=int)
+    parser.add_argument("-o", "--results-folder", help="Where to keep the scene files of the finished jobs and the parsed matches", default=DEFAULT_RESULTS_FOLDER)
+    parser.add_argument("-j", "--processes", help="Number of jobs converted at the same time", default=DEFAULT_PROCESSES, type=int)
+    main.add_client_arguments(parser)
+    main.add_cache_arguments(parser)
+    args = parser.parse_args()
+    main.check_cache_arguments(parser, args)
+
+    main.open_response_cache(args)
+    main.create_crest_client(args)
+    # As in batch.py, importing is done once and the workers split the rate
+    # limit between them.
+    args.import_cache = None
+    if args.rate_limit:
+        args.rate_limit /= float(args.processes)
+
+    service = ConversionService(args.results_folder, args, args.processes)
+    server = _ThreadingHTTPServer((args.host, args.port), create_handler(service))
+    print "Serving on http://%s:%d/jobs" % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print "Stopped"
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,82 @@
+import math
+
+import numpy
+
+import geometry
+
+DEFAULT_POSITION_TOLERANCE = 1.0
+DEFAULT_ANGLE_TOLERANCE = 2.0
+
+
+def sample_track(times, interval):
+    """
+    Returns the indices of the first sample in every interval of the given
+    length, in seconds, plus the last sample.
+    """
+    times = numpy.asarray(times, dtype=numpy.float64)
+    if len(times) == 0:
+        return numpy.arange(0)
+    buckets = numpy.floor((times - times[0]) / interval).astype(numpy.int64)
+    first_in_bucket = numpy.flatnonzero(numpy.diff(buckets)) + 1
+    return numpy.unique(numpy.concatenate(([0], first_in_bucket, [len(times) - 1])))
+
+
+def simplify_track(times, positions, position_tolerance, angle_tolerance=None):
+    """
+    Picks the samples of a track that are needed to reproduce it within the
+    given tolerances when interpolating linearly between them, using the
+    Ramer-Douglas-Peucker algorithm.
+
+    The position error of a sample is its distance from where the simplified
+    curve puts the actor at the same time. The angle error, in degrees, is how
+    far the direction the actor moved in to reach a sample is from the
+    direction of the simplified segment, since that is what the rotation keys
+    face along.
+
+    Returns the indices of the samples to keep, always including the first and
+    the last one.
+    """
+    times = numpy.asarray(times, dtype=numpy.float64)
+    positions = numpy.asarray(positions, dtype=numpy.float64)
+    count = len(times)
+    if count < 3:
+        return numpy.arange(count)
+
+    directions = geometry.normalize_vectors(numpy.diff(positions, axis=0))
+    if angle_tolerance is not None:
+        angle_tolerance = math.radians(angle_tolerance)
+
+    keep = numpy.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    segments = [(0, count - 1)]
+    while segments:
+        first, last = segments.pop()
+        if last - first < 2:
+            continue
+
+        duration = times[last] - times[first]
+        if duration > 0.0:
+            fraction = (times[first + 1:last] - times[first]) / duration
+        else:
+            fraction = numpy.zeros(last - first - 1)
+        expected = positions[first] + fraction[:, numpy.newaxis] * (positions[last] - positions[first])
+        offsets = positions[first + 1:last] - expected
+        error = numpy.sqrt((offsets ** 2).sum(axis=1)) / position_tolerance
+
+        if angle_tolerance is not None:
+            segment_direction = geometry.normalize_vectors([positions[last] - positions[first]])[0]
+            cosines = numpy.clip(directions[first:last].dot(segment_direction), -1.0, 1.0)
+            angle_error = numpy.arccos(cosines) / angle_tolerance
+            # The direction into the last sample can only be fixed by keeping
+            # the one before it.
+            error = numpy.maximum(error, angle_error[:-1])
+            error[-1] = max(error[-1], angle_error[-1])
+
+        worst = int(numpy.argmax(error))
+        if error[worst] > 1.0:
+            split = first + 1 + worst
+            keep[split] = True
+            segments.append((first, split))
+            segments.append((split, last))
+
+    return numpy.flatnonzero(keep)
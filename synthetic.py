@@ -0,0 +1,249 @@
+import json
+import math
+import random
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import crestscrape
+import timeline
+
+DEFAULT_BASE_URL = "http://synthetic.local"
+DEFAULT_SHIPS = 24
+DEFAULT_DRONES = 10
+DEFAULT_FRAMES = 600
+DEFAULT_FIRE_RATE = 0.2
+START_TIME = 130000000000000000
+FRAME_INTERVAL = 10000000
+# CREST lists an effect in every frame while it is active.
+EFFECT_FRAMES = 3
+DEFAULT_AMMO_GRAPHIC_ID = 20043
+RACES = ("amarr", "caldari", "gallente", "minmatar")
+SHIP_RADII = (40.0, 150.0, 600.0)
+
+
+class SyntheticMatch(object):
+    """
+    Generates a match with the same json documents CREST serves for a real
+    one: the match, its static scene data, types, graphic ids and the chain of
+    replay frames. fire_rate is the chance of each ship starting to fire in a
+    frame, and about half of the ships are destroyed during the match.
+    Matches with different match numbers can be served side by side.
+    The documents are kept by url in docs.
+    """
+    def __init__(self, base_url=DEFAULT_BASE_URL, ships=DEFAULT_SHIPS, drones=DEFAULT_DRONES,
+                 frames=DEFAULT_FRAMES, fire_rate=DEFAULT_FIRE_RATE, seed=0, match_number=0):
+        self.base_url = base_url.rstrip("/")
+        self.ship_count = ships
+        self.drone_count = drones
+        self.frame_count = frames
+        self.fire_rate = fire_rate
+        self.random = random.Random(seed)
+        self.match_number = match_number
+        self.match_url = self.get_url("/tournaments/1/series/1/matches/%d/" % match_number)
+        self.docs = {}
+        self.generate()
+
+    def get_url(self, path):
+        return self.base_url + path
+
+    def get_frame_path(self, f):
+        return "/replays/%d/frames/%d/" % (self.match_number, f)
+
+    def add_doc(self, path, doc):
+        url = self.get_url(path)
+        self.docs[url] = doc
+        return {"href": url}
+
+    def generate(self):
+        ships = self.generate_ships()
+        static_scene_data = self.add_doc(self.match_url[len(self.base_url):] + "static/", {
+            "nebulaName": "res:/dx9/scene/universe/synthetic_cube.red",
+            "ships": [ship["static"] for ship in ships],
+        })
+        self.add_doc("/graphicids/%d/" % DEFAULT_AMMO_GRAPHIC_ID, {"graphicFile": "res:/fisfx/ammo/default.red"})
+        for graphic_id in range(500, 504):
+            self.add_doc("/graphicids/%d/" % graphic_id, {"graphicFile": "res:/fisfx/ammo/ammo_%d.red" % graphic_id})
+        drone_type = self.add_doc("/types/2488/", {
+            "graphicID": {"sofDNA": "synthetic_drone:rogue:rogue", "id_str": "2600"},
+            "radius": 5.0,
+        })
+
+        drones = []
+        for i in range(self.drone_count):
+            launch = self.random.randint(0, self.frame_count // 2)
+            drones.append({
+                "id": 9000000 + i,
+                "owner": self.random.randrange(self.ship_count),
+                "launch": launch,
+                "recall": self.random.randint(launch + 1, self.frame_count),
+            })
+
+        first_frame = last_frame = None
+        for f in range(self.frame_count):
+            frame = self.generate_frame(f, ships, drones, drone_type)
+            if f + 1 < self.frame_count:
+                frame["nextFrame"] = {"href": self.get_url(self.get_frame_path(f + 1))}
+            reference = self.add_doc(self.get_frame_path(f), frame)
+            if first_frame is None:
+                first_frame = reference
+            last_frame = reference
+
+        self.add_doc(self.match_url[len(self.base_url):], {
+            "redTeam": {"teamName": "Synthetic Red"},
+            "blueTeam": {"teamName": "Synthetic Blue"},
+            "staticSceneData": static_scene_data,
+            "firstReplayFrame": first_frame,
+            "lastReplayFrame": last_frame,
+        })
+
+    def generate_ships(self):
+        ships = []
+        for i in range(self.ship_count):
+            item_id = 1000000 + i
+            race = RACES[i % len(RACES)]
+            ship_type = self.add_doc("/types/%d/" % (600 + i % 12), {
+                "graphicID": {"sofDNA": "synthetic_hull_%d:synthetic_%s:%s" % (i % 12, race, race), "id_str": str(i % 12)},
+                "radius": SHIP_RADII[i % len(SHIP_RADII)],
+            })
+            turrets = []
+            for slot in range(3):
+                graphic_resource = self.add_doc("/graphicids/%d/" % (300 + slot), {
+                    "graphicFile": "res:/dx9/model/turret/synthetic_%d.red" % slot,
+                })
+                turrets.append({"href": self.get_url("/inventory/items/%d%d/" % (item_id, slot)), "graphicResource": graphic_resource})
+            death = self.frame_count
+            if self.random.random() < 0.5:
+                death = self.random.randint(self.frame_count // 3, self.frame_count)
+            ships.append({
+                "index": i,
+                "id": item_id,
+                "team": i % 2,
+                "radius": 2000.0 + self.random.uniform(0.0, 8000.0),
+                "speed": self.random.uniform(0.005, 0.05),
+                "phase": self.random.uniform(0.0, 2.0 * math.pi),
+                "height": self.random.uniform(-1000.0, 1000.0),
+                "death": death,
+                "modules": ["%d%d" % (item_id, slot) for slot in range(3)],
+                "firing": None,
+                "static": {
+                    "item": {"href": self.get_url("/inventory/items/%d/" % item_id)},
+                    "type": ship_type,
+                    "turrets": turrets,
+                },
+            })
+        return ships
+
+    def generate_frame(self, f, ships, drones, drone_type):
+        time = START_TIME + f * FRAME_INTERVAL
+        alive = [ship for ship in ships if f < ship["death"]]
+        drones_by_owner = {}
+        for drone in drones:
+            if drone["launch"] <= f < drone["recall"]:
+                drones_by_owner.setdefault(drone["owner"], []).append(drone)
+        team_data = ([], [])
+        for ship in alive:
+            angle = ship["phase"] + ship["speed"] * f
+            speed = ship["radius"] * ship["speed"] / timeline.to_seconds(FRAME_INTERVAL)
+            ship_data = {
+                "itemRef": {"href": ship["static"]["item"]["href"]},
+                "physicsData": {
+                    "x": ship["radius"] * math.cos(angle), "y": ship["height"], "z": ship["radius"] * math.sin(angle),
+                    "vx": -speed * math.sin(angle), "vy": 0.0, "vz": speed * math.cos(angle),
+                },
+            }
+            if ship["firing"] is None and self.random.random() < self.fire_rate:
+                targets = [other for other in alive if other["team"] != ship["team"]]
+                if targets:
+                    ship["firing"] = {
+                        "start_frame": f,
+                        "effect": {
+                            "guid": "effects.ProjectileFired",
+                            "startTime": time,
+                            "targetID_str": str(self.random.choice(targets)["id"]),
+                            "ammoGraphicResource": {"href": self.get_url("/graphicids/%d/" % self.random.randint(500, 503))},
+                            "modules": [{"moduleID_str": module} for module in ship["modules"]],
+                        },
+                    }
+            if ship["firing"] is not None:
+                ship_data["effects"] = [ship["firing"]["effect"]]
+                if f - ship["firing"]["start_frame"] >= EFFECT_FRAMES - 1:
+                    ship["firing"] = None
+            ship_drones = drones_by_owner.get(ship["index"])
+            if ship_drones:
+                position = ship_data["physicsData"]
+                ship_data["drones"] = [{
+                    "itemID": drone["id"],
+                    "type": drone_type,
+                    "physicsData": {
+                        "x": position["x"] + 100.0 * math.cos(f * 0.1 + i), "y": position["y"] + 10.0 * i,
+                        "z": position["z"] + 100.0 * math.sin(f * 0.1 + i),
+                        "vx": position["vx"], "vy": 0.0, "vz": position["vz"],
+                    },
+                } for i, drone in enumerate(ship_drones)]
+            team_data[ship["team"]].append(ship_data)
+        return {"time_str": str(time), "redTeamShipData": team_data[0], "blueTeamShipData": team_data[1]}
+
+    def seed_cache(self, response_cache):
+        """
+        Stores every document in a response cache, as if it had been fetched.
+        """
+        for url, doc in self.docs.iteritems():
+            response_cache.put(crestscrape.get_cache_key(url), json.dumps(doc))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInServer(object):
+    """
+    Serves the documents of a SyntheticMatch over HTTP on localhost, standing
+    in for CREST. The match has to be generated with base_url, which is only
+    known once the server is listening.
+    """
+    def __init__(self, port=0):
+        self.docs = {}
+        self.request_count = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.request_count += 1
+                data = stand_in.docs.get(self.path)
+                if data is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.base_url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.thread = None
+
+    def serve(self, match):
+        self.serve_docs(match.docs)
+
+    def serve_docs(self, docs):
+        """
+        Serves more documents, such as a series listing matches, by url.
+        """
+        for url, doc in docs.iteritems():
+            self.docs[urlparse.urlparse(url).path] = json.dumps(doc)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="StandInServer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
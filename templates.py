@@ -15,7 +15,7 @@ rotation_curve_header = """
             endValue: {end_value}
             startTangent: {start_tangent}
             endTangent: {end_tangent}
-            interpolation: 1
+            interpolation: {interpolation}
             timeOffset: {time_offset}"""
 
 scalar_key = """
@@ -24,7 +24,7 @@ scalar_key = """
                     time: {time}
                     leftTangent: {left_tangent}
                     rightTangent: {right_tangent}
-                    interpolation: 1"""
+                    interpolation: {interpolation}"""
 
 vector_key = """
             -   type: Tr2Vector3Key
@@ -32,7 +32,7 @@ vector_key = """
                 value: {value}
                 leftTangent: {left_tangent}
                 rightTangent: {right_tangent}
-                interpolation: 1"""
+                interpolation: {interpolation}"""
 
 location_curve_header = """
     - &location_curve_{object_name}
@@ -43,7 +43,7 @@ location_curve_header = """
         endValue: {end_value}
         startTangent: {start_tangent}
         endTangent: {end_tangent}
-        interpolation: 1
+        interpolation: {interpolation}
         timeOffset: {time_offset}"""
 
 euler_rotation_header = """
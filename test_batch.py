@@ -0,0 +1,89 @@
+import os
+import shutil
+import sys
+import tempfile
+from cStringIO import StringIO
+
+import batch
+import crestscrape
+import main
+import synthetic
+
+server = None
+work_folder = None
+series_url = None
+matches = []
+
+
+def setup():
+    # Two matches listed in a series and a third one with a broken frame,
+    # served by a stand-in for CREST.
+    global server, work_folder, series_url
+    server = synthetic.StandInServer()
+    for match_number in range(3):
+        match = synthetic.SyntheticMatch(server.base_url, ships=4, drones=2, frames=30, seed=match_number,
+                                         match_number=match_number)
+        server.serve(match)
+        matches.append(match)
+    broken_frame_url = matches[2].get_url(matches[2].get_frame_path(10))
+    server.serve_docs({broken_frame_url: {"nextFrame": matches[2].docs[broken_frame_url]["nextFrame"]}})
+    series_url = server.base_url + "/tournaments/1/series/1/"
+    server.serve_docs({
+        series_url: {"matches": {"href": series_url + "matches/"}},
+        series_url + "matches/": {"items": [{"href": match.match_url} for match in matches[:2]]},
+    })
+    server.start()
+
+    work_folder = tempfile.mkdtemp(prefix="test_batch")
+    main.open_response_cache(get_args())
+    main.create_crest_client(get_args())
+
+
+def teardown():
+    crestscrape.get_response_cache().close()
+    crestscrape.set_response_cache(None)
+    crestscrape.set_crest_client(None)
+    server.stop()
+    shutil.rmtree(work_folder, ignore_errors=True)
+
+
+def get_args():
+    return batch.create_parser().parse_args([
+        series_url, "-o", work_folder, "-j", "2", "-c", os.path.join(work_folder, "cache.pack"),
+        "--checkpoint-folder", os.path.join(work_folder, "checkpoints"), "--retries", "0",
+    ])
+
+
+def convert(match_urls):
+    args = get_args()
+    results = batch.convert_matches(match_urls, args.save_folder, args, args.processes)
+    stdout = sys.stdout
+    sys.stdout = summary = StringIO()
+    try:
+        batch.print_summary(results)
+    finally:
+        sys.stdout = stdout
+    return results, summary.getvalue()
+
+
+def test_get_match_urls_expands_series():
+    assert crestscrape.get_match_urls(series_url) == [match.match_url for match in matches[:2]]
+
+
+def test_convert_matches():
+    results, summary = convert(crestscrape.get_match_urls(series_url))
+    assert [result.target_url for result in results] == [match.match_url for match in matches[:2]]
+    for result in results:
+        assert result.succeeded(), result.error
+        scene_save_path, red_save_path = main.get_save_paths(work_folder, result.scene_name)
+        assert os.path.exists(scene_save_path)
+        assert os.path.exists(red_save_path)
+    assert "Converted 2 of 2 matches" in summary
+
+
+def test_broken_match_fails_alone():
+    results, summary = convert([matches[2].match_url, matches[0].match_url])
+    assert not results[0].succeeded()
+    assert results[1].succeeded(), results[1].error
+    assert "Converted 1 of 2 matches" in summary
+    assert "FAILED" in summary and matches[2].match_url in summary
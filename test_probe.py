@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from cStringIO import StringIO
+
+import yaml
+
+import probe
+
+
+def create_scenes():
+    empty = probe.SceneFile(None)
+
+    ships = probe.SceneFile("1001")
+    ships.set_name("Red vs Blue")
+    ships.add_command(["scene", "res:/dx9/scene/universe/a01_cube.red"])
+    ships.add_command(["camera", "main", 1.57, 3.0, 100000.0])
+    ships.add_command(["set_position", "main", [-1000.0, 0.5, 1e-20]])
+    ships.add_actor("1001", "ab1_t1:amarrbase:amarr")
+    ships.fit_turret_to_actor("1001", u"res:/dx9/model/turret/energy/pulse/pulse_s.red", 0)
+    ships.add_command(["add_behavior", "main", "Follow", "1001", 300])
+    ships.add_timed_events([(0.5, [["fire", "1001", 0, "1002", 0.0, u"res:/fisfx/ammo/laser.red"]]),
+                            (2.0, [["explosion_for_actor", "explosion", "res:/fisfx/deathexplosion/death_d_a.red", "1002", 0.5]]),
+                            (2.1, [["remove_actor", "1002"]])])
+
+    unicode_names = probe.SceneFile(u"1001")
+    unicode_names.set_name(u"Ærø Vikings vs Team “Quotes” — 日本 " * 4)
+    unicode_names.add_command(["actor", u"1001", u"res:/dx9/model/ship/ærø/ship.red"])
+    unicode_names.add_command(["fit_turret", "1001", u"res:/dx9/model/turret/été.red", 1])
+    unicode_names.add_command(["actor", "1002", "res:/dx9/model/ship/caf\xc3\xa9.red"])
+    unicode_names.add_command(["comment", u"it's: a [flow] {list} # not a comment", u"", None, True, -0.0, float("inf")])
+    unicode_names.add_command(["set_position", u"1001", [[1.0, 2.0], [u"é", [3.0, u"nested"]]]])
+    # Long enough to be wrapped, which libyaml does differently for non-ASCII.
+    unicode_names.add_command(["actor", "1003", u"res:/dx9/model/ship/" + u"überschall größe " * 8 + u".red"])
+    unicode_names.add_command(["actor", "1004", "res:/dx9/model/ship/" + "caf\xc3\xa9 cr\xc3\xa8me " * 8 + ".red"])
+    unicode_names.add_command(["comment", u"line\nbreak", u"tab\there", u"next\x85line", "bell\x07"])
+
+    nested = probe.SceneFile(None)
+    nested.add_command(["set_position", "1001", [1.0, [2.0, [3.0, []]], {}]])
+    nested.add_command(["behaviors", {"Follow": ["1001", 300], "Orbit": {"distance": 500.0}}])
+    nested.add_command([])
+    nested.add_command(["move_to", "1001", [10 ** 12, -10 ** 12, 0], 2.5])
+
+    return [empty, ships, unicode_names, nested]
+
+
+def write(scene_file, render_cache=None):
+    f = StringIO()
+    scene_file.write(f, render_cache)
+    return f.getvalue()
+
+
+def check_scene(scene_file, chunk_size):
+    # The pure python dumper is what the scene files were always written with.
+    expected = yaml.dump(scene_file.data, Dumper=yaml.Dumper)
+    saved_chunk_size = probe.COMMAND_CHUNK_SIZE
+    probe.COMMAND_CHUNK_SIZE = chunk_size
+    try:
+        assert write(scene_file) == expected
+        render_cache = probe.RenderCache()
+        assert write(scene_file, render_cache) == expected
+        assert write(scene_file, render_cache) == expected
+    finally:
+        probe.COMMAND_CHUNK_SIZE = saved_chunk_size
+
+
+def check_scenes():
+    for scene_file in create_scenes():
+        for chunk_size in (1, 2, probe.COMMAND_CHUNK_SIZE):
+            check_scene(scene_file, chunk_size)
+
+
+def test_write_matches_yaml_dump():
+    check_scenes()
+
+
+def test_write_matches_yaml_dump_without_libyaml():
+    # Reloads probe as it is loaded where PyYAML was built without libyaml.
+    c_dumper = getattr(yaml, "CDumper", None)
+    if c_dumper is not None:
+        del yaml.CDumper
+    try:
+        reload(probe)
+        assert probe.Dumper is yaml.Dumper
+        check_scenes()
+    finally:
+        if c_dumper is not None:
+            yaml.CDumper = c_dumper
+        reload(probe)
@@ -0,0 +1,74 @@
+# Times are kept as integer ticks since the first replay frame, in the 100
+# nanosecond units CREST uses, and only turned into seconds for the output.
+import bisect
+import heapq
+import itertools
+
+TICKS_PER_SECOND = 10000000
+
+
+def to_seconds(ticks):
+    return ticks / float(TICKS_PER_SECOND)
+
+
+def to_ticks(seconds):
+    return int(round(seconds * TICKS_PER_SECOND))
+
+
+class EventTrack(object):
+    """
+    Events sorted by tick, in two parallel lists. Events nearly always arrive
+    in order and are appended, the few that do not are inserted after the
+    events already at their tick.
+    """
+    def __init__(self):
+        self.ticks = []
+        self.events = []
+        # The events before this index are as they were when take_changes was
+        # last called.
+        self.changed_from = 0
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def __iter__(self):
+        return itertools.izip(self.ticks, self.events)
+
+    def add(self, tick, event):
+        if not self.ticks or tick >= self.ticks[-1]:
+            self.ticks.append(tick)
+            self.events.append(event)
+        else:
+            i = bisect.bisect_right(self.ticks, tick)
+            self.ticks.insert(i, tick)
+            self.events.insert(i, event)
+            self.changed_from = min(self.changed_from, i)
+
+    def take_changes(self):
+        """
+        Returns the index of the first event added since the last call, and
+        the ticks and events from there on.
+        """
+        start = min(self.changed_from, len(self.ticks))
+        self.changed_from = len(self.ticks)
+        return start, self.ticks[start:], self.events[start:]
+
+    def apply_changes(self, start, ticks, events):
+        self.ticks[start:] = ticks
+        self.events[start:] = events
+        self.changed_from = len(self.ticks)
+
+
+def _tag(stream, order):
+    for tick, event in stream:
+        yield tick, order, event
+
+
+def merge(*streams):
+    """
+    Merges streams of (tick, event) pairs, each sorted by tick, into a single
+    sorted stream. Events at the same tick come in the order of the streams
+    they are from.
+    """
+    for tick, order, event in heapq.merge(*[_tag(stream, order) for order, stream in enumerate(streams)]):
+        yield tick, event
@@ -0,0 +1,120 @@
+import numpy
+
+import timeline
+from geometry import Vector
+
+INITIAL_CAPACITY = 256
+
+
+class Trajectory(object):
+    """
+    The positions and velocities of a single actor, stored as one row per frame
+    in growable arrays. Rows are appended in frame order, so the ticks are
+    always sorted.
+    """
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.size = 0
+        self._frames = numpy.empty(capacity, dtype=numpy.int64)
+        self._ticks = numpy.empty(capacity, dtype=numpy.int64)
+        self._positions = numpy.empty((capacity, 3), dtype=numpy.float64)
+        self._velocities = numpy.empty((capacity, 3), dtype=numpy.float64)
+
+    def _grow(self):
+        capacity = len(self._frames) * 2
+        self._frames = numpy.resize(self._frames, capacity)
+        self._ticks = numpy.resize(self._ticks, capacity)
+        self._positions = numpy.resize(self._positions, (capacity, 3))
+        self._velocities = numpy.resize(self._velocities, (capacity, 3))
+
+    def append(self, frame, tick, position, velocity):
+        if self.size == len(self._frames):
+            self._grow()
+        i = self.size
+        self._frames[i] = frame
+        self._ticks[i] = tick
+        self._positions[i] = position
+        self._velocities[i] = velocity
+        self.size += 1
+
+    def extend(self, trajectory):
+        """
+        Appends the rows of another trajectory.
+        """
+        while self.size + trajectory.size > len(self._frames):
+            self._grow()
+        rows = slice(self.size, self.size + trajectory.size)
+        self._frames[rows] = trajectory.frames
+        self._ticks[rows] = trajectory.ticks
+        self._positions[rows] = trajectory.positions
+        self._velocities[rows] = trajectory.velocities
+        self.size += trajectory.size
+
+    def __getstate__(self):
+        # Only the used rows are worth storing.
+        return {
+            "frames": self.frames.copy(),
+            "ticks": self.ticks.copy(),
+            "positions": self.positions.copy(),
+            "velocities": self.velocities.copy(),
+        }
+
+    def __setstate__(self, state):
+        self.size = len(state["frames"])
+        self._frames = state["frames"]
+        self._ticks = state["ticks"]
+        self._positions = state["positions"]
+        self._velocities = state["velocities"]
+        if self.size == 0:
+            self.__init__()
+
+    @classmethod
+    def from_arrays(cls, frames, ticks, positions, velocities):
+        trajectory = cls.__new__(cls)
+        trajectory.__setstate__({"frames": frames, "ticks": ticks, "positions": positions, "velocities": velocities})
+        return trajectory
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def frames(self):
+        return self._frames[:self.size]
+
+    @property
+    def ticks(self):
+        return self._ticks[:self.size]
+
+    @property
+    def times(self):
+        # In seconds.
+        return timeline.to_seconds(self.ticks)
+
+    @property
+    def positions(self):
+        return self._positions[:self.size]
+
+    @property
+    def velocities(self):
+        return self._velocities[:self.size]
+
+    def tail(self, start):
+        """
+        Returns a new trajectory holding copies of the rows from start on.
+        """
+        trajectory = Trajectory(max(self.size - start, 1))
+        count = self.size - start
+        trajectory._frames[:count] = self._frames[start:self.size]
+        trajectory._ticks[:count] = self._ticks[start:self.size]
+        trajectory._positions[:count] = self._positions[start:self.size]
+        trajectory._velocities[:count] = self._velocities[start:self.size]
+        trajectory.size = count
+        return trajectory
+
+    def get_location(self, index):
+        return Vector(*self._positions[index].tolist())
+
+    def start_location(self):
+        return self.get_location(0)
+
+    def end_location(self):
+        return self.get_location(self.size - 1)